@@ -0,0 +1,212 @@
+# Threshold alerting evaluated incrementally on the ingest path
+#
+# Rules live in alerts.json, keyed by sensor name ("*" applies to sensors without their own rules):
+#
+# {
+#     "a4:c1:38:da:5e:ca": [
+#         {"name": "freezer-warm", "type": "above", "threshold": -15, "hysteresis": 1},
+#         {"name": "freezer-door", "type": "rate", "delta": 3, "minutes": 10},
+#         {"name": "freezer-silent", "type": "stale", "minutes": 30}
+#     ],
+#     "*": [{"type": "below", "threshold": 2, "hysteresis": 0.5}]
+# }
+#
+# Rules are compiled once into a small per-sensor table, so evaluating a reading costs
+# a dict lookup plus a handful of comparisons - it never touches the logger's ring buffer.
+import asyncio
+import json
+import time
+
+RULE_ABOVE = 0
+RULE_BELOW = 1
+RULE_RATE = 2
+RULE_STALE = 3
+
+_RULE_TYPES = {'above': RULE_ABOVE, 'below': RULE_BELOW, 'rate': RULE_RATE, 'stale': RULE_STALE}
+
+class AlertRule:
+    """One compiled rule plus its evaluation state"""
+    __slots__ = ['name', 'kind', 'threshold', 'param', 'active', 'ref_time', 'ref_temp', 'since']
+
+    def __init__(self, name, kind, threshold=0.0, param=0.0):
+        self.name = name
+        self.kind = kind
+        self.threshold = threshold  # above/below: limit, rate: delta in C
+        self.param = param          # above/below: hysteresis, rate/stale: window in seconds
+        self.active = False
+        self.ref_time = None        # rate: start of the current window
+        self.ref_temp = 0.0         # rate: temperature at the start of the window
+        self.since = 0.0            # When the alert last changed state
+
+class AlertEngine:
+    def __init__(self, max_events=20):
+        """
+        Per-sensor threshold, rate-of-change and staleness alerts
+
+        Args:
+            max_events: Number of recent alert transitions kept for HTTP/MQTT
+        """
+        self.config = {}          # sensor_name -> list of rule dicts (as loaded)
+        self.tables = {}          # sensor_name -> list of AlertRule ("*" sensors added when first seen)
+        self.last_seen = {}       # sensor_name -> timestamp of last reading
+        self.max_events = max_events
+        self.recent = []          # Recent transitions, newest last (bounded)
+        self.pending = []         # Transitions not yet published to MQTT (bounded)
+        self.listeners = []       # Callables invoked with each transition
+        self.event = asyncio.Event()  # Set when pending gains an entry
+
+    def load(self, path='alerts.json'):
+        """Load and compile rules from a JSON file. A missing or invalid file means no alerts."""
+        try:
+            with open(path) as f:
+                config = json.load(f)
+        except OSError:
+            print(f"No alert rules loaded ({path} not found)")
+            config = {}
+        except ValueError as e:
+            print(f"Invalid alert rules in {path}: {e}")
+            config = {}
+        try:
+            self.compile(config)
+        except ValueError as e:
+            print(f"Invalid alert rules in {path}: {e}")
+            self.compile({})
+
+    def compile(self, config):
+        """
+        Validate rule dicts and build the per-sensor tables
+
+        Every rule is compiled here, so a bad rule is reported at load time rather than
+        failing each reading on the ingest path.
+
+        Raises:
+            ValueError: config is not {sensor_name: [rule, ...]} or a rule is incomplete
+        """
+        if not isinstance(config, dict):
+            raise ValueError("rules must be an object keyed by sensor name")
+        tables = {}
+        for sensor_name, rules in config.items():
+            # "*" is built once here to validate it; each sensor it covers gets its own copy
+            tables[sensor_name] = self._build(sensor_name, rules)
+        self.config = config
+        self.tables = {name: table for name, table in tables.items() if name != '*'}
+        rule_count = sum(len(rules) for rules in config.values())
+        print(f"Alert rules loaded: {rule_count} rules for {len(config)} sensors")
+
+    def _build(self, sensor_name, rules):
+        # Compile one sensor's rule dicts into AlertRules with fresh state
+        if not isinstance(rules, list):
+            raise ValueError(f"Rules for {sensor_name} must be a list")
+        table = []
+        for i, rule in enumerate(rules):
+            if not isinstance(rule, dict):
+                raise ValueError(f"Rule {i} for {sensor_name} must be an object")
+            kind = _RULE_TYPES.get(rule.get('type'))
+            if kind is None:
+                raise ValueError(f"Unknown alert type {rule.get('type')!r} for {sensor_name}")
+            name = rule.get('name') or f"{rule['type']}{i}"
+            try:
+                if kind == RULE_ABOVE or kind == RULE_BELOW:
+                    table.append(AlertRule(name, kind, float(rule['threshold']), float(rule.get('hysteresis', 0.5))))
+                elif kind == RULE_RATE:
+                    table.append(AlertRule(name, kind, float(rule['delta']), float(rule.get('minutes', 10)) * 60))
+                else:
+                    table.append(AlertRule(name, kind, 0.0, float(rule.get('minutes', 30)) * 60))
+            except KeyError as e:
+                raise ValueError(f"Alert rule {name} for {sensor_name} is missing {e}")
+            except (TypeError, ValueError):
+                raise ValueError(f"Alert rule {name} for {sensor_name} has a non-numeric setting")
+        return table
+
+    def _table_for(self, sensor_name):
+        # Sensors with their own rules were built by compile(); the rest get a "*" table when first seen
+        table = self.tables.get(sensor_name)
+        if table is None:
+            table = self.tables[sensor_name] = self._build(sensor_name, self.config.get('*', []))
+        return table
+
+    def on_reading(self, sensor_name, reading):
+        """Logger reading hook - O(rules for this sensor), no history access"""
+        now = reading.last_updated
+        self.last_seen[sensor_name] = now
+        temperature = reading.temperature
+        if temperature is None:
+            return
+
+        for rule in self._table_for(sensor_name):
+            kind = rule.kind
+            if kind == RULE_ABOVE:
+                if not rule.active and temperature > rule.threshold:
+                    self._transition(sensor_name, rule, True, temperature, now)
+                elif rule.active and temperature <= rule.threshold - rule.param:
+                    self._transition(sensor_name, rule, False, temperature, now)
+            elif kind == RULE_BELOW:
+                if not rule.active and temperature < rule.threshold:
+                    self._transition(sensor_name, rule, True, temperature, now)
+                elif rule.active and temperature >= rule.threshold + rule.param:
+                    self._transition(sensor_name, rule, False, temperature, now)
+            elif kind == RULE_RATE:
+                if rule.ref_time is None:
+                    rule.ref_time = now
+                    rule.ref_temp = temperature
+                    continue
+                exceeded = abs(temperature - rule.ref_temp) >= rule.threshold
+                if exceeded and not rule.active:
+                    self._transition(sensor_name, rule, True, temperature, now)
+                if now - rule.ref_time >= rule.param:
+                    # Window elapsed - start a new one from this reading
+                    if rule.active and not exceeded:
+                        self._transition(sensor_name, rule, False, temperature, now)
+                    rule.ref_time = now
+                    rule.ref_temp = temperature
+            elif rule.active:
+                # A reading arrived, so a stale alert clears
+                self._transition(sensor_name, rule, False, temperature, now)
+
+    def check_stale(self, now=None):
+        """Fire stale alerts for sensors that have gone quiet. O(sensors with rules)."""
+        if now is None:
+            now = time.time()
+        for sensor_name, table in self.tables.items():
+            last_seen = self.last_seen.get(sensor_name, now)
+            for rule in table:
+                if rule.kind == RULE_STALE and not rule.active and now - last_seen >= rule.param:
+                    self._transition(sensor_name, rule, True, None, now)
+
+    async def run_stale_checks(self, interval_s=60):
+        """Background task driving the stale-for-N-minutes rules"""
+        while True:
+            await asyncio.sleep(interval_s)
+            self.check_stale()
+
+    def _transition(self, sensor_name, rule, active, temperature, now):
+        rule.active = active
+        rule.since = now
+        alert = {
+            'sensor': sensor_name,
+            'rule': rule.name,
+            'state': 'firing' if active else 'cleared',
+            'value': temperature,
+            'ts': now
+        }
+        print(f"Alert {alert['state']}: {sensor_name} {rule.name} ({temperature})")
+
+        self.recent.append(alert)
+        if len(self.recent) > self.max_events:
+            self.recent.pop(0)
+        self.pending.append(alert)
+        if len(self.pending) > self.max_events:
+            self.pending.pop(0)  # Drop the oldest unpublished alert rather than grow
+        self.event.set()
+
+        for listener in self.listeners:
+            listener(alert)
+
+    def get_active(self):
+        """List of (sensor_name, rule_name, since) for alerts currently firing"""
+        active = []
+        for sensor_name, table in self.tables.items():
+            for rule in table:
+                if rule.active:
+                    active.append((sensor_name, rule.name, rule.since))
+        return active
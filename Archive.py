@@ -0,0 +1,413 @@
+# btree-indexed multi-day archive of logger records
+#
+# Key layout (all big-endian so btree order is sensor, then time):
+#   'r' + aid (2 bytes) + absolute minute (4 bytes)  -> temperature * 100 ('<h')
+#   'h' + aid (2 bytes) + absolute hour (4 bytes)    -> rollup '<hhiH': min, max, sum, count (* 100)
+#   'd' + aid (2 bytes) + absolute day (4 bytes)     -> rollup, as for hourly
+#   'n' + sensor name                                -> aid ('>H')
+#   'v'                                              -> layout version (archives without it used
+#                                                       1-byte aids and are converted on open)
+#
+# Retention is tiered: raw records older than raw_days are compacted into hourly rollups,
+# hourly rollups older than hourly_days into daily rollups, and daily rollups are kept forever.
+#
+# aid is an archive-local sensor ID. Logger sensor IDs are recycled and reassigned at every
+# boot, so the archive keeps its own stable name -> aid registry. Absolute minutes are
+# counted from the MicroPython epoch, so keys never collide across days.
+import asyncio
+import os
+import struct
+import time
+import btree
+
+KEY_RAW = 0x72       # 'r'
+KEY_HOURLY = 0x68    # 'h'
+KEY_DAILY = 0x64     # 'd'
+KEY_NAME = b'n'
+KEY_VERSION = b'v'
+LAYOUT_VERSION = 2
+RAW_KEY = '>BHI'     # prefix, aid, minute / hour / day
+OLD_RAW_KEY = '>BBI' # Layout 1
+AID_VALUE = '>H'
+MAX_AIDS = 65536     # Neighbours' sensors come and go, and their daily rollups are kept forever
+ROLLUP_VALUE = '<hhiH'
+SCAN_BATCH = 32      # Keys read per btree seek; no btree cursor is held across a yield
+COMPACT_SLICE_MS = 5 # Longest a single compaction slice may hold the loop
+TIER_KEYS = {'raw': KEY_RAW, 'hourly': KEY_HOURLY, 'daily': KEY_DAILY}
+TIER_SECONDS = {KEY_RAW: 60, KEY_HOURLY: 3600, KEY_DAILY: 86400}
+
+class Archive:
+    def __init__(self, path='temps.db', cachesize=0, raw_days=7, hourly_days=365):
+        """
+        Open (or create) the archive database
+
+        Args:
+            path: btree file on flash
+            cachesize: btree page cache size in bytes (0 for the module default)
+            raw_days: Days raw records are kept before being compacted into hourly rollups
+            hourly_days: Days hourly rollups are kept before being compacted into daily rollups
+        """
+        try:
+            self.file = open(path, 'r+b')
+        except OSError:
+            self.file = open(path, 'w+b')
+        self.db = btree.open(self.file, cachesize=cachesize)
+        if self.db.get(KEY_VERSION) is None:
+            self._upgrade_layout()
+
+        self.name_to_aid = {}
+        self.aid_to_name = {}
+        for key, value in self.db.items(KEY_NAME, b'o'):
+            sensor_name = bytes(key[1:]).decode()
+            aid = struct.unpack(AID_VALUE, value)[0]
+            self.name_to_aid[sensor_name] = aid
+            self.aid_to_name[aid] = sensor_name
+
+        self.next_seq = 0          # Logger sequence number to resume archiving from
+        self.records_archived = 0
+
+        self.raw_seconds = int(raw_days * 86400)
+        self.hourly_seconds = int(hourly_days * 86400)
+        self.compacted = {KEY_RAW: 0, KEY_HOURLY: 0}  # Source keys folded into the next tier
+        self.compaction_runs = 0
+        self.last_compaction_ms = 0   # Wall time of the most recent complete pass
+        self.max_slice_ms = 0         # Longest the loop was held by one slice
+        self.measured = {}            # Tier lag and flash usage as of the last compaction pass
+        self._measure_storage(time.time())
+
+    def _upgrade_layout(self):
+        # One-off conversion of a layout 1 archive (1-byte aids); a new archive just gets the marker.
+        # Old and new keys are told apart by length, so an interrupted conversion resumes safely.
+        converted = 0
+        for prefix in (KEY_DAILY, KEY_HOURLY, KEY_RAW):
+            start = bytes((prefix,))
+            end = bytes((prefix + 1,))
+            while True:
+                batch = []
+                for key, value in self.db.items(start, end):
+                    batch.append((bytes(key), bytes(value)))
+                    if len(batch) >= SCAN_BATCH:
+                        break
+                for key, value in batch:
+                    if len(key) == 6:
+                        _, aid, unit = struct.unpack(OLD_RAW_KEY, key)
+                        self.db[self._key(aid, unit, prefix)] = value
+                        del self.db[key]
+                        converted += 1
+                if len(batch) < SCAN_BATCH:
+                    break
+                start = batch[-1][0] + b'\x00'  # Just past the last key looked at
+        names = [(bytes(key), bytes(value)) for key, value in self.db.items(KEY_NAME, b'o')]
+        for key, value in names:
+            if len(value) == 1:
+                self.db[key] = struct.pack(AID_VALUE, value[0])
+        self.db[KEY_VERSION] = bytes((LAYOUT_VERSION,))
+        self.db.flush()
+        if converted:
+            print(f"Archive: converted {converted} keys to 2-byte sensor IDs")
+
+    def _aid(self, sensor_name, create=False):
+        aid = self.name_to_aid.get(sensor_name)
+        if aid is None and create:
+            aid = len(self.name_to_aid)
+            if aid >= MAX_AIDS:
+                raise ValueError(f"Archive supports at most {MAX_AIDS} sensors")
+            self.db[KEY_NAME + sensor_name.encode()] = struct.pack(AID_VALUE, aid)
+            self.name_to_aid[sensor_name] = aid
+            self.aid_to_name[aid] = sensor_name
+        return aid
+
+    def _key(self, aid, minute, prefix=KEY_RAW):
+        return struct.pack(RAW_KEY, prefix, aid, minute)
+
+    def put(self, sensor_name, timestamp, temperature):
+        """
+        Insert one record (idempotent - a sensor and minute already archived are left alone)
+
+        Returns:
+            False if the record was already archived
+        """
+        key = self._key(self._aid(sensor_name, create=True), int(timestamp // 60))
+        if self.db.get(key) is not None:
+            return False
+        self.db[key] = struct.pack('<h', int(temperature * 100))
+        return True
+
+    async def archive_from(self, logger, batch=SCAN_BATCH):
+        """
+        Bulk-insert finished ring records not yet archived, yielding between batches
+
+        A record is finished once min_interval has passed since its last update - after
+        that the logger can only append a new record for that sensor.
+
+        Returns:
+            Number of records inserted
+        """
+        now = time.time()
+        cutoff = now - logger.min_interval_seconds
+        compacted_before = now - self.raw_seconds
+        inserted = 0
+        in_batch = 0
+
+        cursor = logger.cursor(start_seq=self.next_seq)
+        for seq, timestamp, sensor_id, temperature in cursor:
+            if timestamp > cutoff:
+                break  # Still open for updates - resume here next time
+            # Records already past raw retention were compacted before; re-inserting them
+            # would count them twice in the hourly tier
+            if timestamp >= compacted_before and self.put(logger._sensor_name(sensor_id), timestamp, temperature):
+                inserted += 1
+            self.next_seq = seq + 1
+
+            in_batch += 1
+            if in_batch >= batch:
+                self.db.flush()
+                in_batch = 0
+                await asyncio.sleep_ms(0)
+
+        self.db.flush()
+        self.records_archived += inserted
+        return inserted
+
+    def scan(self, sensor_name, since=None, until=None):
+        """
+        Iterate (timestamp, temperature) for one sensor in time order
+
+        Keys are fetched SCAN_BATCH at a time with a fresh seek for each batch, so the caller
+        may await between items while new records are being inserted.
+        """
+        aid = self._aid(sensor_name)
+        if aid is None:
+            return
+        start_minute = int(since // 60) if since is not None else 0
+        end_key = self._key(aid, int(until // 60)) if until is not None else self._key(aid, 0xFFFFFFFF)
+
+        while True:
+            batch = []
+            for key, value in self.db.items(self._key(aid, start_minute), end_key):
+                batch.append((struct.unpack_from(RAW_KEY, key)[2], value))
+                if len(batch) >= SCAN_BATCH:
+                    break
+            for minute, value in batch:
+                yield minute * 60, struct.unpack('<h', value)[0] / 100.0
+            if len(batch) < SCAN_BATCH:
+                return
+            start_minute = batch[-1][0] + 1
+
+    def iter_csv(self, sensor_names, since=None, until=None):
+        """Iterate CSV lines (timestamp,sensor_name,temperature) for the CSV exporters"""
+        for sensor_name in sensor_names:
+            for timestamp, temperature in self.scan(sensor_name, since, until):
+                yield f"{int(timestamp)},{sensor_name},{temperature:.2f}\n"
+
+    def scan_rollup(self, sensor_name, tier, since=None, until=None):
+        """
+        Iterate (timestamp, min, max, avg, count) for one sensor from the hourly or daily tier
+
+        Timestamps are the start of each hour / day. Batched and re-seeked like scan().
+        """
+        prefix = TIER_KEYS[tier]
+        period = TIER_SECONDS[prefix]
+        aid = self._aid(sensor_name)
+        if aid is None:
+            return
+        start = int(since // period) if since is not None else 0
+        end_key = self._key(aid, int(until // period), prefix) if until is not None else self._key(aid, 0xFFFFFFFF, prefix)
+
+        while True:
+            batch = []
+            for key, value in self.db.items(self._key(aid, start, prefix), end_key):
+                batch.append((struct.unpack_from(RAW_KEY, key)[2], value))
+                if len(batch) >= SCAN_BATCH:
+                    break
+            for unit, value in batch:
+                t_min, t_max, t_sum, count = struct.unpack(ROLLUP_VALUE, value)
+                yield unit * period, t_min / 100.0, t_max / 100.0, t_sum / count / 100.0, count
+            if len(batch) < SCAN_BATCH:
+                return
+            start = batch[-1][0] + 1
+
+    def prune(self, before, limit=None):
+        """
+        Delete raw records older than `before` with key-range deletes
+
+        Args:
+            before: Timestamp; records before this minute are removed
+            limit: Stop after this many deletions (None for no limit)
+
+        Returns:
+            Number of records deleted
+        """
+        before_minute = int(before // 60)
+        deleted = 0
+        for aid in self.aid_to_name:
+            end_key = self._key(aid, before_minute)
+            while limit is None or deleted < limit:
+                # Collect first - a btree must not be modified while iterating it
+                keys = []
+                for key in self.db.keys(self._key(aid, 0), end_key):
+                    keys.append(key)
+                    if len(keys) >= SCAN_BATCH:
+                        break
+                if not keys:
+                    break
+                for key in keys:
+                    del self.db[key]
+                deleted += len(keys)
+        self.db.flush()
+        return deleted
+
+    def _compact_slice(self, src, dst, aid, before_unit, ratio, deadline):
+        # Fold the oldest src keys of one sensor below before_unit into dst rollups.
+        # Returns the number of src keys folded (0 once this sensor is caught up).
+        keys = []
+        for key, value in self.db.items(self._key(aid, 0, src), self._key(aid, before_unit, src)):
+            keys.append((bytes(key), bytes(value)))
+            if len(keys) >= SCAN_BATCH:
+                break
+        if not keys:
+            return 0
+
+        folded = 0
+        rollup_unit = None
+        t_min = t_max = t_sum = count = 0
+        for key, value in keys:
+            unit = struct.unpack_from(RAW_KEY, key)[2] // ratio
+            if unit != rollup_unit:
+                if rollup_unit is not None:
+                    self._merge_rollup(dst, aid, rollup_unit, t_min, t_max, t_sum, count)
+                    if time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+                        break  # Out of time - the rest of the batch waits for the next slice
+                rollup_unit = unit
+                t_min, t_max, t_sum, count = 32767, -32768, 0, 0
+
+            if src == KEY_RAW:
+                v_min = v_max = v_sum = struct.unpack('<h', value)[0]
+                v_count = 1
+            else:
+                v_min, v_max, v_sum, v_count = struct.unpack(ROLLUP_VALUE, value)
+            t_min = min(t_min, v_min)
+            t_max = max(t_max, v_max)
+            t_sum += v_sum
+            count += v_count
+            # Delete only after reading - the batch was collected up front, so no cursor is open
+            del self.db[key]
+            folded += 1
+        else:
+            self._merge_rollup(dst, aid, rollup_unit, t_min, t_max, t_sum, count)
+
+        self.compacted[src] += folded
+        return folded
+
+    def _merge_rollup(self, prefix, aid, unit, t_min, t_max, t_sum, count):
+        # Periods are compacted in slices, so a rollup may already hold part of its period
+        key = self._key(aid, unit, prefix)
+        existing = self.db.get(key)
+        if existing is not None:
+            e_min, e_max, e_sum, e_count = struct.unpack(ROLLUP_VALUE, existing)
+            t_min = min(t_min, e_min)
+            t_max = max(t_max, e_max)
+            t_sum += e_sum
+            count += e_count
+        self.db[key] = struct.pack(ROLLUP_VALUE, t_min, t_max, t_sum, min(count, 0xFFFF))
+
+    async def run_retention(self, interval_s=3600):
+        """
+        Background task enforcing the retention tiers
+
+        Work is done in slices of at most SCAN_BATCH keys and COMPACT_SLICE_MS, with a
+        yield to the loop after each, so BLE scanning and HTTP keep running during a pass.
+        """
+        while True:
+            await asyncio.sleep(interval_s)
+            try:
+                await self.compact()
+            except Exception as e:
+                # Keep the task alive - a failed pass (flash error, corrupt key) is retried next interval
+                print(f"Archive compaction error: {e}")
+
+    async def compact(self, now=None):
+        """
+        Run one full retention pass, yielding between slices
+
+        Returns:
+            Number of keys folded into the next tier
+        """
+        if now is None:
+            now = time.time()
+        started = time.ticks_ms()
+        # Cut-offs are aligned to the destination period so only whole periods are rolled up
+        tiers = ((KEY_RAW, KEY_HOURLY, 60, int((now - self.raw_seconds) // 3600)),
+                 (KEY_HOURLY, KEY_DAILY, 24, int((now - self.hourly_seconds) // 86400)))
+        total = 0
+
+        for src, dst, ratio, before in tiers:
+            for aid in list(self.aid_to_name):
+                while True:
+                    slice_start = time.ticks_ms()
+                    folded = self._compact_slice(src, dst, aid, before * ratio, ratio,
+                                                 time.ticks_add(slice_start, COMPACT_SLICE_MS))
+                    self.db.flush()
+                    slice_ms = time.ticks_diff(time.ticks_ms(), slice_start)
+                    if slice_ms > self.max_slice_ms:
+                        self.max_slice_ms = slice_ms
+                    total += folded
+                    await asyncio.sleep_ms(0)
+                    if folded == 0:
+                        break
+
+        self.compaction_runs += 1
+        self.last_compaction_ms = time.ticks_diff(time.ticks_ms(), started)
+        self._measure_storage(now)
+        print(f"Archive compaction: {total} keys folded in {self.last_compaction_ms}ms")
+        return total
+
+    def _oldest(self, prefix):
+        # Timestamp of the oldest key in a tier across all sensors (one seek per sensor)
+        oldest = None
+        for aid in self.aid_to_name:
+            for key in self.db.keys(self._key(aid, 0, prefix), self._key(aid, 0xFFFFFFFF, prefix)):
+                timestamp = struct.unpack_from(RAW_KEY, key)[2] * TIER_SECONDS[prefix]
+                if oldest is None or timestamp < oldest:
+                    oldest = timestamp
+                break
+        return oldest
+
+    def _measure_storage(self, now):
+        # The btree seeks and statvfs behind these are done once per compaction pass,
+        # not on every stats request or metrics scrape
+        measured = {}
+        for name, prefix, keep in (('raw', KEY_RAW, self.raw_seconds), ('hourly', KEY_HOURLY, self.hourly_seconds)):
+            oldest = self._oldest(prefix)
+            measured[f'{name}_lag_s'] = max(0, int(now - keep - oldest)) if oldest is not None else 0
+
+        try:
+            fs = os.statvfs('/')
+            measured['flash_total_bytes'] = fs[1] * fs[2]
+            measured['flash_free_bytes'] = fs[1] * fs[4]
+        except OSError:
+            pass
+        self.measured = measured
+
+    def get_storage_stats(self):
+        """
+        Flash usage and compaction metrics
+
+        Lag is how far the oldest key of a tier is past that tier's retention cut-off,
+        i.e. 0 when compaction is keeping up. Lag and flash figures are as of the last
+        compaction pass.
+        """
+        stats = {
+            'records_archived': self.records_archived,
+            'compacted_raw': self.compacted[KEY_RAW],
+            'compacted_hourly': self.compacted[KEY_HOURLY],
+            'compaction_runs': self.compaction_runs,
+            'last_compaction_ms': self.last_compaction_ms,
+            'max_slice_ms': self.max_slice_ms
+        }
+        stats.update(self.measured)
+        return stats
+
+    def close(self):
+        self.db.close()
+        self.file.close()
@@ -1,49 +1,34 @@
 import time
-#import btree
+from Archive import Archive
 
 # Create an empty dictionary to store sensor data
 sensor_data = {}
-db = None
-f = None
+archive = None
 
-def OpenDB():
-    pass
-    '''global f
-    global db
+def OpenDB(path="temps.db"):
+    # History is archived from the logger's ring buffer (see Archive.archive_from), keyed by
+    # archive sensor ID + absolute minute so days never collide
+    global archive
 
-    try:
-        f = open("temps.db", "r+b")
-    except OSError:
-        f = open("temps.db", "w+b")
-
-    db = btree.open(f)'''
+    if archive is None:
+        archive = Archive(path)
+    return archive
 
 def CloseDB():
-    global f
-    global db
-
-    if db is not None:
-        db.close()
-
-    if f is not None:
-        f.close()
-
-def DumpDB():
-    global f
-    global db
+    global archive
 
-    Target = "da:5e:ca"
-    hex_addr = Target.split(':')
-    last_three_hex = hex_addr[-3:]
-    addr_bytes = bytes(int(value, 16) for value in last_three_hex)
+    if archive is not None:
+        archive.close()
+        archive = None
 
+def DumpDB(Target="a4:c1:38:da:5e:ca", hours=24):
     # Print the "Parents" temp values
-    for key in db.keys(addr_bytes + bytes.fromhex("0000"), addr_bytes + bytes.fromhex("059f")):
-        last_two_bytes = key[-2:]
-        minutes_since_midnight = int.from_bytes(last_two_bytes, 'big')
-
-        print(f"{minutes_since_midnight // 60:02d}:{minutes_since_midnight % 60:02d}", end='-')
-        print(int.from_bytes(db[key], 'big') / 100, end=', ')
+    since = time.time() - hours * 3600
+    for timestamp, temperature in archive.scan(Target, since):
+        t = time.localtime(int(timestamp) + 3600*10)
+        print(f"{t[1]:02d}-{t[2]:02d} {t[3]:02d}:{t[4]:02d}", end='-')
+        print(temperature, end=', ')
+    print()
 
 def GetData():
     l = list()
@@ -64,28 +49,8 @@ def GetData():
     return(l)
 
 async def UpdateData(addr, name, temperature, humidity, battery, rssi, voltage, power):
-    global f
-    global db
-    
-    if temperature is not None:
-        # Store this value in the database. The key is the last three bytes of the address & the time in secs since midnight
-        '''t = time.localtime(time.time() + 3600*10)
-        minutes_since_midnight = t[3]*60 + t[4]
-        time_bytes = minutes_since_midnight.to_bytes(2, 'big')
-
-        hex_addr = addr.split(':')
-        last_three_hex = hex_addr[-3:]
-        addr_bytes = bytes(int(value, 16) for value in last_three_hex)
-        key = addr_bytes + time_bytes
-
-        value = int(temperature * 100).to_bytes(2, 'big')
-        db[key] = value
-        #Unhandled exception in IRQ callback handler
-        #Traceback (most recent call last):
-        # File "<stdin>", line 119, in handle_scan
-        # File "Data.py", line 79, in UpdateData
-        # OSError: 0
-        db.flush()'''
+    # Temperatures are not written to the database here: this runs for every advert, so the
+    # archive is filled in batches from the logger instead (see Archive.archive_from)
 
     # If we haven't seen this sensor before, store the results in a dictionary. Use the MAC address as a key
     if addr not in sensor_data:
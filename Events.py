@@ -0,0 +1,76 @@
+# Publish/subscribe hub feeding push clients (Server-Sent Events, WebSockets)
+#
+# The logger's reading hook and the alert engine's listeners publish here. Each subscriber
+# has its own small bounded queue, so a slow or stalled client only ever loses its own
+# oldest events - publishing never blocks and never allocates more than one small tuple.
+import asyncio
+
+EVENT_READING = 0  # (EVENT_READING, sensor_name, timestamp, temperature, humidity, battery, rssi)
+EVENT_ALERT = 1    # (EVENT_ALERT, alert dict from AlertEngine)
+
+class Subscriber:
+    """One push client's queue"""
+    __slots__ = ['queue', 'event', 'sensors', 'max_queue', 'dropped']
+
+    def __init__(self, sensors=None, max_queue=16):
+        self.queue = []              # Pending events, oldest first
+        self.event = asyncio.Event() # Set when the queue gains an entry
+        self.sensors = sensors       # Set of sensor names to receive readings for (None for all)
+        self.max_queue = max_queue
+        self.dropped = 0             # Events discarded because the client fell behind
+
+    def push(self, item):
+        if item[0] == EVENT_READING:
+            # Latest wins: a queued reading for the same sensor is superseded, not repeated
+            for i, queued in enumerate(self.queue):
+                if queued[0] == EVENT_READING and queued[1] == item[1]:
+                    self.queue[i] = item
+                    self.event.set()
+                    return
+        if len(self.queue) >= self.max_queue:
+            self.queue.pop(0)
+            self.dropped += 1
+        self.queue.append(item)
+        self.event.set()
+
+class EventHub:
+    def __init__(self, max_queue=16):
+        """
+        Fan-out of live readings and alerts to push clients
+
+        Args:
+            max_queue: Events buffered per subscriber before its oldest are dropped
+        """
+        self.max_queue = max_queue
+        self.subscribers = []
+        self.published = 0
+
+    def subscribe(self, sensors=None):
+        """Register a client; sensors is an iterable of names to filter readings by (None for all)"""
+        subscriber = Subscriber(set(sensors) if sensors is not None else None, self.max_queue)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+    def on_reading(self, sensor_name, reading):
+        """Logger reading hook. The reading object is reused by the logger, so its fields are copied."""
+        if not self.subscribers:
+            return
+        item = (EVENT_READING, sensor_name, reading.last_updated, reading.temperature,
+                reading.humidity, reading.battery_level, reading.rssi)
+        self.published += 1
+        for subscriber in self.subscribers:
+            if subscriber.sensors is None or sensor_name in subscriber.sensors:
+                subscriber.push(item)
+
+    def on_alert(self, alert):
+        """AlertEngine listener"""
+        if not self.subscribers:
+            return
+        item = (EVENT_ALERT, alert)
+        self.published += 1
+        for subscriber in self.subscribers:
+            subscriber.push(item)
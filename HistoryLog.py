@@ -0,0 +1,334 @@
+# Crash-safe append-only history log on the internal flash filesystem
+#
+# Every record the TemperatureLogger appends or updates is also appended here, so the
+# RAM ring can be rebuilt after a reboot or power cut. Layout:
+#
+#   <directory>/<segment number>.log   Segments are written in order and rotated once they
+#                                      reach segment_size; the oldest is deleted beyond max_segments
+#   block   = header + payload         header is '<HHI': magic, payload length, CRC32 of payload
+#   payload = entries                  RECORD '<BBIh': kind, sensor_id, timestamp, temperature * 100
+#                                      SENSOR: kind, sensor_id, name length, name bytes
+#
+# Sensor IDs are only meaningful within a segment: a SENSOR entry is written before the first
+# record of each sensor in a segment, so every segment can be replayed (or deleted) on its own.
+# A torn or corrupt block ends replay of its segment; after recovery a fresh segment is started
+# so new blocks are never appended behind a torn one.
+import asyncio
+import os
+import struct
+import time
+from binascii import crc32
+
+from Logger import RECORD_UPDATED
+
+BLOCK_MAGIC = 0x4C48  # "HL"
+BLOCK_HEADER = '<HHI'
+BLOCK_HEADER_SIZE = 8
+MAX_BLOCK_SIZE = 4096  # Anything claiming to be larger is treated as corruption
+ENTRY_RECORD = '<BBIh'
+ENTRY_RECORD_SIZE = 8
+ENTRY_SENSOR = 2  # Record kinds 0/1 come from Logger.RECORD_APPENDED / RECORD_UPDATED
+
+class HistoryLog:
+    def __init__(self, directory='hist', segment_size=16384, max_segments=8, block_size=512):
+        """
+        Segment-rotated append log for ring buffer records
+
+        Args:
+            directory: Flash directory holding the segment files
+            segment_size: Bytes per segment before rotating to a new file
+            max_segments: Segments kept on flash (oldest deleted first)
+            block_size: Size of the RAM write buffer, i.e. the largest block payload
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.block_size = min(block_size, MAX_BLOCK_SIZE)
+
+        # Bounded write buffer - entries accumulate here until the next flush
+        self.buffer = bytearray(self.block_size)
+        self.buffer_len = 0
+
+        self.segments = []      # Segment numbers on flash, oldest first
+        self.file = None        # Open handle for the newest segment
+        self.segment_bytes = 0  # Bytes written to the newest segment
+        self.declared = {}      # sensor_id -> sensor_name declared in the newest segment
+
+        self.blocks_written = 0
+        self.bytes_written = 0
+        self.write_errors = 0
+        self.last_flush_ms = 0   # Latency of the most recent block write
+        self.max_flush_ms = 0    # Worst block write latency seen
+
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass  # Already exists
+
+    def _path(self, number):
+        return f"{self.directory}/{number:08d}.log"
+
+    def _scan_segments(self):
+        self.segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.log'):
+                try:
+                    self.segments.append(int(name[:-4]))
+                except ValueError:
+                    pass
+        self.segments.sort()
+
+    def _open_segment(self):
+        # Start a new segment after the newest one and drop segments beyond the limit
+        if self.file is not None:
+            self.file.close()
+        number = self.segments[-1] + 1 if self.segments else 0
+        self.file = open(self._path(number), 'wb')
+        self.segments.append(number)
+        self.segment_bytes = 0
+        self.declared = {}
+
+        while len(self.segments) > self.max_segments:
+            oldest = self.segments.pop(0)
+            try:
+                os.remove(self._path(oldest))
+            except OSError as e:
+                print(f"History log: failed to remove segment {oldest}: {e}")
+
+    def on_record(self, kind, sensor_id, sensor_name, timestamp, temperature):
+        """Logger record hook. Only buffers in RAM; writes a block when the buffer fills."""
+        name_bytes = None
+        if self.declared.get(sensor_id) != sensor_name:
+            name_bytes = sensor_name.encode()[:255]
+
+        needed = ENTRY_RECORD_SIZE + (3 + len(name_bytes) if name_bytes is not None else 0)
+        if self.buffer_len + needed > self.block_size:
+            self.flush()
+            if name_bytes is None and self.declared.get(sensor_id) != sensor_name:
+                # The flush rotated to a new segment - declare the sensor again
+                name_bytes = sensor_name.encode()[:255]
+
+        if name_bytes is not None:
+            offset = self.buffer_len
+            self.buffer[offset] = ENTRY_SENSOR
+            self.buffer[offset + 1] = sensor_id
+            self.buffer[offset + 2] = len(name_bytes)
+            self.buffer[offset + 3:offset + 3 + len(name_bytes)] = name_bytes
+            self.buffer_len = offset + 3 + len(name_bytes)
+            self.declared[sensor_id] = sensor_name
+
+        struct.pack_into(ENTRY_RECORD, self.buffer, self.buffer_len,
+                         kind, sensor_id, int(timestamp), int(temperature * 100))
+        self.buffer_len += ENTRY_RECORD_SIZE
+
+    def flush(self):
+        """
+        Write buffered entries to flash as one CRC-protected block
+
+        Returns:
+            Number of bytes written
+        """
+        if self.buffer_len == 0:
+            return 0
+
+        started = time.ticks_ms()
+        try:
+            if self.file is None:
+                self._open_segment()
+            payload = memoryview(self.buffer)[:self.buffer_len]
+            self.file.write(struct.pack(BLOCK_HEADER, BLOCK_MAGIC, self.buffer_len, crc32(payload)))
+            self.file.write(payload)
+            self.file.flush()
+        except OSError as e:
+            # Keep the buffer bounded - drop this block rather than retry forever. The segment
+            # may now end in a torn block, and the sensors this block declared are lost with it,
+            # so the next block starts a new segment (and declares its sensors again).
+            print(f"History log write failed: {e}")
+            self.write_errors += 1
+            self.buffer_len = 0
+            if self.file is not None:
+                try:
+                    self.file.close()
+                except OSError:
+                    pass
+                self.file = None
+            self.declared = {}
+            return 0
+
+        written = BLOCK_HEADER_SIZE + self.buffer_len
+        self.segment_bytes += written
+        self.buffer_len = 0
+        self.blocks_written += 1
+        self.bytes_written += written
+        self.last_flush_ms = time.ticks_diff(time.ticks_ms(), started)
+        if self.last_flush_ms > self.max_flush_ms:
+            self.max_flush_ms = self.last_flush_ms
+
+        if self.segment_bytes >= self.segment_size:
+            self._open_segment()
+
+        return written
+
+    def position(self):
+        """(segment, offset) just past the last block written - pass to recover() to resume there"""
+        if not self.segments:
+            return (0, 0)
+        return (self.segments[-1], self.segment_bytes)
+
+    def recover(self, logger, start=None):
+        """
+        Replay every intact block into the logger, oldest first, then start a new segment
+
+        Args:
+            logger: TemperatureLogger to replay into
+            start: (segment, offset) from position() - only blocks from there on are
+                applied (e.g. those written after a snapshot). None replays everything.
+
+        Returns:
+            Number of records replayed
+        """
+        self._scan_segments()
+        header = bytearray(BLOCK_HEADER_SIZE)
+        payload = bytearray(MAX_BLOCK_SIZE)
+        replayed = 0
+        start_segment, start_offset = start if start is not None else (0, 0)
+
+        for number in self.segments:
+            if number < start_segment:
+                continue
+            names = {}  # sensor_id -> sensor_name, per segment
+            offset = 0
+            try:
+                with open(self._path(number), 'rb') as f:
+                    while True:
+                        if f.readinto(header) != BLOCK_HEADER_SIZE:
+                            break
+                        magic, length, crc = struct.unpack(BLOCK_HEADER, header)
+                        if magic != BLOCK_MAGIC or length > MAX_BLOCK_SIZE:
+                            print(f"History log: bad block header in segment {number}, skipping rest")
+                            break
+                        view = memoryview(payload)[:length]
+                        if f.readinto(view) != length or crc32(view) != crc:
+                            print(f"History log: torn block in segment {number}, skipping rest")
+                            break
+                        # Blocks before the start offset only contribute their sensor declarations
+                        apply = number > start_segment or offset >= start_offset
+                        replayed += self._replay_block(view, names, logger, apply)
+                        offset += BLOCK_HEADER_SIZE + length
+            except OSError as e:
+                print(f"History log: cannot read segment {number}: {e}")
+
+        print(f"History log recovered {replayed} records from {len(self.segments)} segments")
+        self._open_segment()
+        return replayed
+
+    def _replay_block(self, view, names, logger, apply=True):
+        replayed = 0
+        offset = 0
+        length = len(view)
+        while offset < length:
+            if view[offset] == ENTRY_SENSOR:
+                sensor_id = view[offset + 1]
+                name_length = view[offset + 2]
+                names[sensor_id] = bytes(view[offset + 3:offset + 3 + name_length]).decode()
+                offset += 3 + name_length
+                continue
+
+            if not apply:
+                offset += ENTRY_RECORD_SIZE
+                continue
+            kind, sensor_id, timestamp, temp_scaled = struct.unpack_from(ENTRY_RECORD, view, offset)
+            offset += ENTRY_RECORD_SIZE
+            sensor_name = names.get(sensor_id)
+            if sensor_name is not None and logger.restore_record(kind, sensor_name, timestamp, temp_scaled / 100.0):
+                replayed += 1
+        return replayed
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class WriteBehind:
+    def __init__(self, log, durability_minutes=2, flush_bytes=None):
+        """
+        Write-behind front end for a HistoryLog
+
+        In-place updates are latest-wins, so only the newest update per sensor is kept
+        until something forces it out: an append for that sensor, the size threshold,
+        or the durability window expiring.
+
+        Args:
+            log: HistoryLog to write through to
+            durability_minutes: Longest a change may sit in RAM, i.e. the most a power cut can lose
+            flush_bytes: Write a block once this many bytes are buffered (default 3/4 of a block)
+        """
+        self.log = log
+        self.durability_ms = int(durability_minutes * 60000)
+        self.flush_bytes = flush_bytes if flush_bytes is not None else log.block_size * 3 // 4
+        self.updates = {}        # sensor_id -> [sensor_name, timestamp, temperature], latest wins
+        self.dirty_since = None  # ticks_ms of the oldest change not yet on flash
+        self.coalesced = 0       # Updates absorbed by a newer update for the same record
+        self.flushes = 0
+
+    def on_record(self, kind, sensor_id, sensor_name, timestamp, temperature):
+        """Logger record hook"""
+        if self.dirty_since is None:
+            self.dirty_since = time.ticks_ms()
+
+        pending = self.updates.get(sensor_id)
+        if kind == RECORD_UPDATED:
+            if pending is None:
+                self.updates[sensor_id] = [sensor_name, timestamp, temperature]
+            else:
+                # Reuse the pending entry - the older update is simply superseded
+                pending[0] = sensor_name
+                pending[1] = timestamp
+                pending[2] = temperature
+                self.coalesced += 1
+            return
+
+        # A new record closes the previous one, so its final update must go first
+        if pending is not None:
+            del self.updates[sensor_id]
+            self.log.on_record(RECORD_UPDATED, sensor_id, pending[0], pending[1], pending[2])
+        self.log.on_record(kind, sensor_id, sensor_name, timestamp, temperature)
+
+        if self.log.buffer_len >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        """Push pending updates into the log and write everything to flash"""
+        for sensor_id, pending in self.updates.items():
+            self.log.on_record(RECORD_UPDATED, sensor_id, pending[0], pending[1], pending[2])
+        self.updates.clear()
+        self.log.flush()
+        self.dirty_since = None
+        self.flushes += 1
+
+    async def run(self, check_interval_s=5):
+        """Background task enforcing the durability window"""
+        while True:
+            await asyncio.sleep(check_interval_s)
+            if (self.dirty_since is not None and
+                    time.ticks_diff(time.ticks_ms(), self.dirty_since) >= self.durability_ms):
+                self.flush()
+
+    def get_stats(self):
+        """Flush counters for status/metrics output"""
+        return {
+            'flushes': self.flushes,
+            'blocks_written': self.log.blocks_written,
+            'bytes_written': self.log.bytes_written,
+            'write_errors': self.log.write_errors,
+            'last_flush_ms': self.log.last_flush_ms,
+            'max_flush_ms': self.log.max_flush_ms,
+            'coalesced_updates': self.coalesced,
+            'pending_updates': len(self.updates),
+            'buffered_bytes': self.log.buffer_len
+        }
+
+    def close(self):
+        self.flush()
+        self.log.close()
@@ -1,7 +1,15 @@
 # Drop-in replacement for TemperatureLogger with memory optimizations
+import random
 import struct
 import time
 
+# Record hook kinds: a new ring record was appended, or the latest one was updated in place
+RECORD_APPENDED = 0
+RECORD_UPDATED = 1
+
+# Aggregate functions understood by TemperatureLogger.query()
+QUERY_AGGREGATES = ('count', 'min', 'max', 'avg', 'sum', 'first', 'last', 'last_ts')
+
 class SensorReading:
     """Memory-efficient sensor reading using slots"""
     __slots__ = ['temperature', 'humidity', 'battery_level', 'rssi', 'voltage', 'power', 'last_updated']
@@ -16,14 +24,95 @@ class SensorReading:
         self.power = power
         self.last_updated = last_updated
 
+class HistoryCursor:
+    """
+    Snapshot-consistent cursor over the ring buffer.
+    
+    Captures the append sequence, head and tail at creation and reads the live
+    buffer in place (no copy). Records appended after creation are not returned.
+    Slots overwritten by the ring wrapping while the cursor is suspended are
+    detected from the sequence numbers: a forward cursor skips past them, a
+    reverse cursor stops cleanly. Clearing the logger ends every open cursor.
+    A forward cursor can start part way through the ring at start_seq.
+    
+    Records are decoded with struct.unpack_from straight out of a memoryview of
+    the ring, so a full scan allocates no per-record bytes objects.
+    
+    Yields (seq, timestamp, sensor_id, temperature) tuples.
+    """
+    __slots__ = ['logger', 'ring_epoch', 'head', 'tail', 'head_seq', 'first_seq', 'end_seq',
+                 'next_seq', 'reverse', 'sensor_id', 'sensor_generation']
+    
+    def __init__(self, logger, reverse=False, sensor_id=None, max_scan=None, start_seq=None):
+        self.logger = logger
+        self.ring_epoch = logger.ring_epoch
+        self.head = logger.head
+        self.tail = logger.tail
+        self.head_seq = logger.append_seq  # Sequence number that lives at self.head
+        self.end_seq = logger.append_seq
+        self.first_seq = logger.append_seq - logger.count
+        if max_scan is not None:
+            # Only look at the newest (reverse) or oldest (forward) max_scan slots
+            if reverse:
+                self.first_seq = max(self.first_seq, self.end_seq - max_scan)
+            else:
+                self.end_seq = min(self.end_seq, self.first_seq + max_scan)
+        if start_seq is not None and not reverse and start_seq > self.first_seq:
+            self.first_seq = min(start_seq, self.end_seq)
+        self.reverse = reverse
+        self.sensor_id = sensor_id
+        # A recycled sensor ID gets a new generation; a filtered cursor must not follow it
+        self.sensor_generation = logger.sensor_generations[sensor_id] if sensor_id is not None else 0
+        self.next_seq = self.end_seq - 1 if reverse else self.first_seq
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        logger = self.logger
+        while True:
+            if logger.ring_epoch != self.ring_epoch:
+                raise StopIteration
+            if self.sensor_id is not None and logger.sensor_generations[self.sensor_id] != self.sensor_generation:
+                raise StopIteration
+            
+            # Oldest sequence number still held in the ring right now
+            oldest_seq = logger.append_seq - logger.count
+            
+            if self.reverse:
+                seq = self.next_seq
+                if seq < self.first_seq or seq < oldest_seq:
+                    # Everything older has been overwritten since we started
+                    raise StopIteration
+                self.next_seq = seq - 1
+            else:
+                if self.next_seq < oldest_seq:
+                    # Skip slots overwritten while we were suspended
+                    self.next_seq = oldest_seq
+                seq = self.next_seq
+                if seq >= self.end_seq:
+                    raise StopIteration
+                self.next_seq = seq + 1
+            
+            pos = (self.head - (self.head_seq - seq)) % logger.max_readings
+            relative_minutes, sensor_id, temp_scaled = struct.unpack_from(
+                '<HBh', logger.view, pos * logger.record_size)
+            
+            if self.sensor_id is not None and sensor_id != self.sensor_id:
+                continue
+            
+            return seq, logger.start_time + (relative_minutes * 60), sensor_id, temp_scaled / 100.0
+
 class TemperatureLogger:
-    def __init__(self, max_readings=2880, min_interval_minutes=5):
+    def __init__(self, max_readings=2880, min_interval_minutes=5, reclaim_after_minutes=60):
         """
         Custom ring buffer temperature logger with latest-wins storage
         
         Args:
             max_readings: Maximum number of readings to store
             min_interval_minutes: Minimum minutes between stored readings per sensor
+            reclaim_after_minutes: Sensor IDs with no stored records and no detailed
+                reading newer than this are recycled for new sensors
         """
         self.record_size = 5
         self.max_readings = max_readings
@@ -32,9 +121,14 @@ class TemperatureLogger:
         
         # Custom ring buffer using bytearray
         self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)  # Zero-copy access for cursors
         self.head = 0  # Write position (next slot to write)
         self.tail = 0  # Read position (oldest data)
         self.count = 0  # Number of records currently stored
+        self.append_seq = 0  # Total records ever appended (sequence number of the next record)
+        self.ring_epoch = 0  # Bumped whenever existing records are invalidated (clear, snapshot load)
+        self.boot_id = random.getrandbits(24)  # Sequence numbers restart with a fresh ring; tags sync cursors
+        self.generation = 0  # Bumped on every change to the stored records; keys cached responses
         
         self.start_time = time.time()
         self.min_interval_seconds = min_interval_minutes * 60
@@ -44,6 +138,7 @@ class TemperatureLogger:
         self.last_stored_time_array = [0.0] * self.max_sensors  # Pre-allocated array
         self.detailed_readings_array = [None] * self.max_sensors  # Pre-allocated array
         self.sensor_record_counts = [0] * self.max_sensors  # Track records per sensor
+        self.sensor_generations = bytearray(self.max_sensors)  # Bumped each time an ID is recycled
         
         # Per-sensor storage limit (24 hours at 5-min intervals = 288 records)
         self.max_records_per_sensor = (24 * 60) // min_interval_minutes
@@ -51,14 +146,22 @@ class TemperatureLogger:
         # Keep minimal lookup dict for compatibility
         self.name_to_id = {}      # sensor_name -> sensor_id (much smaller now)
         self.id_to_name = {}      # Keep for compatibility but use array lookup
-        self.next_sensor_id = 0   # Next available sensor ID
+        self.next_sensor_id = 0   # High-water mark of allocated sensor IDs (free IDs below it stay as None slots)
+        self.free_sensor_ids = [] # Recycled IDs below next_sensor_id, lowest reused first
+        self.reclaim_seconds = reclaim_after_minutes * 60
         
         # Legacy compatibility properties (now backed by arrays)
         self.last_stored_time = {}  # Will be populated on-demand for compatibility
         self.last_detailed_readings = {}  # Will be populated on-demand for compatibility
         
+        # Callables run with (sensor_name, SensorReading) after every detailed reading.
+        # They run on the ingest path, so they must be O(1) and must not scan the ring.
+        self.reading_hooks = []
+        # Callables run with (kind, sensor_id, sensor_name, timestamp, temperature) whenever
+        # a ring record is appended (RECORD_APPENDED) or updated in place (RECORD_UPDATED)
+        self.record_hooks = []
+        
         # Reusable objects to avoid allocations
-        self._temp_records = []
         self._temp_result = {}
         
         print(f"Custom ring buffer initialized: {max_readings} readings, {buffer_size} bytes")
@@ -70,18 +173,94 @@ class TemperatureLogger:
         if sensor_name in self.name_to_id:
             return self.name_to_id[sensor_name]
         
-        if self.next_sensor_id >= self.max_sensors:
+        if not self.free_sensor_ids and self.next_sensor_id >= self.max_sensors:
+            # Table full - try to recycle IDs of sensors that have gone away
+            self.reclaim_sensor_ids()
+        
+        if self.free_sensor_ids:
+            # Reuse the lowest free ID, filling holes before the high-water mark grows
+            sensor_id = self.free_sensor_ids.pop(0)
+        elif self.next_sensor_id < self.max_sensors:
+            sensor_id = self.next_sensor_id
+            self.next_sensor_id += 1
+        else:
             raise ValueError(f"Maximum {self.max_sensors} sensors supported")
         
-        sensor_id = self.next_sensor_id
         self.name_to_id[sensor_name] = sensor_id
         self.id_to_name[sensor_id] = sensor_name  # Keep for compatibility
         self.sensor_names[sensor_id] = sensor_name  # Store in array too
-        self.next_sensor_id += 1
         
         print(f"New sensor registered: '{sensor_name}' -> ID {sensor_id}")
         return sensor_id
     
+    def _is_sensor_reclaimable(self, sensor_id, current_time):
+        """A sensor ID can be recycled once it has no stored records and no recent reading"""
+        if self.sensor_names[sensor_id] is None or self.sensor_record_counts[sensor_id] > 0:
+            return False
+        if current_time - self.last_stored_time_array[sensor_id] < self.reclaim_seconds:
+            return False
+        reading = self.detailed_readings_array[sensor_id]
+        if reading is not None and current_time - reading.last_updated < self.reclaim_seconds:
+            return False
+        return True
+    
+    def _release_sensor_id(self, sensor_id):
+        """
+        Unregister a sensor and put its ID on the free-list
+        
+        IDs are never remapped, so live sensors keep their IDs (ring records, cursors and
+        history log entries refer to them). Only trailing free IDs lower next_sensor_id; a
+        freed ID below the highest live one stays a None slot that per-sensor loops skip
+        until _get_or_create_sensor_id hands it out again.
+        """
+        sensor_name = self.sensor_names[sensor_id]
+        print(f"Sensor ID {sensor_id} reclaimed from '{sensor_name}'")
+        
+        self.name_to_id.pop(sensor_name, None)
+        self.id_to_name.pop(sensor_id, None)
+        self.sensor_names[sensor_id] = None
+        self.last_stored_time_array[sensor_id] = 0.0
+        self.detailed_readings_array[sensor_id] = None
+        self.sensor_record_counts[sensor_id] = 0
+        # New generation: anything still holding the old (id, generation) pair can tell it is stale
+        self.sensor_generations[sensor_id] = (self.sensor_generations[sensor_id] + 1) & 0xFF
+        
+        if sensor_id == self.next_sensor_id - 1:
+            # Lower the high-water mark past any trailing free slots
+            self.next_sensor_id -= 1
+            while self.next_sensor_id > 0 and self.sensor_names[self.next_sensor_id - 1] is None:
+                self.next_sensor_id -= 1
+            self.free_sensor_ids = [i for i in self.free_sensor_ids if i < self.next_sensor_id]
+        else:
+            # Keep the free-list sorted so the lowest ID is reused first
+            i = 0
+            while i < len(self.free_sensor_ids) and self.free_sensor_ids[i] < sensor_id:
+                i += 1
+            self.free_sensor_ids.insert(i, sensor_id)
+    
+    def reclaim_sensor_ids(self):
+        """
+        Recycle IDs of sensors with zero stored records and no recent detailed reading
+        
+        Returns:
+            Number of sensor IDs reclaimed
+        """
+        current_time = time.time()
+        reclaimed = 0
+        # Walk downwards so trailing slots compact the high-water mark as we go
+        for sensor_id in range(self.next_sensor_id - 1, -1, -1):
+            if self._is_sensor_reclaimable(sensor_id, current_time):
+                self._release_sensor_id(sensor_id)
+                reclaimed += 1
+        return reclaimed
+    
+    def get_sensor_generation(self, sensor_name):
+        """Get (sensor_id, generation) for a sensor, or None if not registered"""
+        if sensor_name not in self.name_to_id:
+            return None
+        sensor_id = self.name_to_id[sensor_name]
+        return sensor_id, self.sensor_generations[sensor_id]
+    
     def add_reading(self, sensor_name, temperature):
         """
         Add temperature reading with proper 5-minute spacing:
@@ -95,30 +274,62 @@ class TemperatureLogger:
         last_storage_time = self.last_stored_time_array[sensor_id]
         time_since_last_storage = current_time - last_storage_time
         
+        kind = RECORD_APPENDED
         if time_since_last_storage >= self.min_interval_seconds:
             # Store as new reading (global ring buffer handles eviction)
             self._store_new_reading(sensor_name, temperature, current_time)
             self.last_stored_time_array[sensor_id] = current_time
         else:
             # Update existing reading in place
-            if not self._update_existing_reading(sensor_name, temperature, current_time):
+            if self._update_existing_reading(sensor_name, temperature, current_time):
+                kind = RECORD_UPDATED
+            else:
                 # Fallback: store as new if update failed
                 self._store_new_reading(sensor_name, temperature, current_time)
                 self.last_stored_time_array[sensor_id] = current_time
         
+        for hook in self.record_hooks:
+            hook(kind, sensor_id, sensor_name, current_time, temperature)
+        
+        return True
+    
+    def restore_record(self, kind, sensor_name, timestamp, temperature):
+        """
+        Replay a persisted record into the ring (used at boot). Record hooks are not run.
+        
+        Returns:
+            False if the record is older than anything the ring can represent
+        """
+        if timestamp < self.start_time:
+            if self.count:
+                return False
+            # Empty ring - move the time reference back so older records fit
+            self.start_time = timestamp
+        
+        sensor_id = self._get_or_create_sensor_id(sensor_name)
+        if kind == RECORD_UPDATED and self._update_existing_reading(sensor_name, temperature, timestamp):
+            return True
+        
+        self._store_new_reading(sensor_name, temperature, timestamp)
+        self.last_stored_time_array[sensor_id] = timestamp
         return True
     
     async def add_detailed_reading(self, sensor_name, temperature, humidity=None, battery_level=None, 
-                           rssi=None, voltage=None, power=None):
+                           rssi=None, voltage=None, power=None, store=True):
         """
         Add a detailed reading with additional sensor information.
         This will store the temperature in the ring buffer (following normal interval rules)
         AND store all detailed info for the last reading.
+        
+        Args:
+            store: False for a repeated advert - refresh the detailed reading and run the
+                   reading hooks (liveness, alerts, push clients) but leave the ring alone
         """
         current_time = time.time()
         
         # Store temperature in ring buffer using existing logic
-        self.add_reading(sensor_name, temperature)
+        if store:
+            self.add_reading(sensor_name, temperature)
         
         # Get or create sensor ID for detailed storage
         sensor_id = self._get_or_create_sensor_id(sensor_name)
@@ -140,6 +351,9 @@ class TemperatureLogger:
             existing_reading.power = power
             existing_reading.last_updated = current_time
         
+        for hook in self.reading_hooks:
+            hook(sensor_name, self.detailed_readings_array[sensor_id])
+        
         return True
     
     def get_last_detailed_reading(self, sensor_name):
@@ -344,97 +558,61 @@ class TemperatureLogger:
         sensor_id = self.name_to_id[sensor_name]
         
         # Search backwards from head to find most recent reading for this sensor
-        pos = (self.head - 1) % self.max_readings
-        
-        for i in range(min(self.count, 50)):  # Limit search to recent readings
-            start_byte = pos * self.record_size
-            record_data = self.buffer[start_byte:start_byte + self.record_size]
-            
-            try:
-                _, stored_sensor_id, _ = struct.unpack('<HBh', record_data)
-                if stored_sensor_id == sensor_id:
-                    # Found the most recent reading for this sensor - update it
-                    self._overwrite_reading_at_position(pos, sensor_name, temperature, timestamp)
-                    return True
-            except:
-                pass
-                
-            pos = (pos - 1) % self.max_readings
+        # Limit search to recent readings
+        for seq, _, _, _ in HistoryCursor(self, reverse=True, sensor_id=sensor_id, max_scan=50):
+            # Found the most recent reading for this sensor - update it
+            self._overwrite_reading_at_position(self._position_of(seq), sensor_name, temperature, timestamp)
+            return True
         
         return False
     
+    def _position_of(self, seq):
+        """Ring buffer slot currently holding the record with this sequence number"""
+        return (self.head - (self.append_seq - seq)) % self.max_readings
+    
     def _overwrite_reading_at_position(self, position, sensor_name, temperature, timestamp):
         """Overwrite the reading at the specified ring buffer position"""
         sensor_id = self.name_to_id[sensor_name]
         
-        # Calculate relative time
-        relative_minutes = int((timestamp - self.start_time) / 60)
-        if relative_minutes > 65535:
-            self._reset_time_reference()
-            relative_minutes = 0
+        relative_minutes = self._relative_minutes(timestamp)
         
-        # Pack new data
+        # Pack new data in place
         temp_scaled = int(temperature * 100)
-        data = struct.pack('<HBh', relative_minutes, sensor_id, temp_scaled)
-        
-        # Overwrite at position
-        start_byte = position * self.record_size
-        end_byte = start_byte + self.record_size
-        self.buffer[start_byte:end_byte] = data
+        struct.pack_into('<HBh', self.buffer, position * self.record_size,
+                         relative_minutes, sensor_id, temp_scaled)
+        self.generation += 1
     
     def _replace_oldest_record(self, sensor_name, temperature, timestamp):
         """Find and replace the oldest record for this sensor (enforces 24h limit)"""
         sensor_id = self.name_to_id[sensor_name]
         
         # Find oldest record for this sensor
-        pos = self.tail
-        for i in range(self.count):
-            start_byte = pos * self.record_size
-            record_data = self.buffer[start_byte:start_byte + self.record_size]
-            
-            try:
-                _, stored_sensor_id, _ = struct.unpack('<HBh', record_data)
-                if stored_sensor_id == sensor_id:
-                    # Found oldest record for this sensor - overwrite it
-                    self._overwrite_reading_at_position(pos, sensor_name, temperature, timestamp)
-                    return
-            except:
-                pass
-            
-            pos = (pos + 1) % self.max_readings
+        for seq, _, _, _ in HistoryCursor(self, sensor_id=sensor_id):
+            # Found oldest record for this sensor - overwrite it
+            self._overwrite_reading_at_position(self._position_of(seq), sensor_name, temperature, timestamp)
+            return
     
     def _store_new_reading(self, sensor_name, temperature, timestamp):
         """Store a completely new reading (append to ring buffer)"""
         sensor_id = self._get_or_create_sensor_id(sensor_name)
         
-        # Calculate relative time
-        relative_minutes = int((timestamp - self.start_time) / 60)
-        if relative_minutes > 65535:
-            self._reset_time_reference()
-            relative_minutes = 0
-        
-        # Pack data
-        temp_scaled = int(temperature * 100)
-        data = struct.pack('<HBh', relative_minutes, sensor_id, temp_scaled)
+        relative_minutes = self._relative_minutes(timestamp)
         
         # Check if we're about to overwrite a record
         overwritten_sensor_id = None
         if self.count >= self.max_readings:
-            # Buffer full - we'll overwrite the tail record
-            start_byte = self.tail * self.record_size
-            record_data = self.buffer[start_byte:start_byte + self.record_size]
-            try:
-                _, overwritten_sensor_id, _ = struct.unpack('<HBh', record_data)
-            except:
-                pass
-        
-        # Append to ring buffer
-        start_pos = self.head * self.record_size
-        end_pos = start_pos + self.record_size
-        self.buffer[start_pos:end_pos] = data
+            # Buffer full - we'll overwrite the tail record (sensor ID is byte 2 of a record)
+            overwritten_sensor_id = self.buffer[self.tail * self.record_size + 2]
+        
+        # Append to ring buffer, packing in place
+        temp_scaled = int(temperature * 100)
+        struct.pack_into('<HBh', self.buffer, self.head * self.record_size,
+                         relative_minutes, sensor_id, temp_scaled)
         
         # Update ring buffer pointers
         self.head = (self.head + 1) % self.max_readings
+        self.append_seq += 1
+        self.generation += 1
         
         if self.count < self.max_readings:
             self.count += 1
@@ -444,14 +622,50 @@ class TemperatureLogger:
             # Decrement count for overwritten sensor
             if overwritten_sensor_id is not None:
                 self.sensor_record_counts[overwritten_sensor_id] -= 1
+                # Its last record just aged out - recycle the ID if the sensor has gone quiet
+                if (overwritten_sensor_id != sensor_id and
+                        self._is_sensor_reclaimable(overwritten_sensor_id, timestamp)):
+                    self._release_sensor_id(overwritten_sensor_id)
         
         # Increment count for new sensor record
         self.sensor_record_counts[sensor_id] += 1
     
-    def _reset_time_reference(self):
-        """Reset time reference when approaching 45-day limit"""
-        print("Resetting time reference (45-day limit reached)")
-        self.start_time = time.time()
+    def _relative_minutes(self, timestamp):
+        """Minutes since start_time for a new record, rebasing the reference past the 16-bit limit"""
+        relative_minutes = int((timestamp - self.start_time) / 60)
+        if relative_minutes > 65535:
+            self._reset_time_reference(timestamp)
+            relative_minutes = int((timestamp - self.start_time) / 60)
+        return relative_minutes
+    
+    def _reset_time_reference(self, timestamp):
+        """
+        Move start_time up to the oldest live record when approaching the 45-day limit
+        
+        Stored relative minutes are shifted by the same amount, so every record still decodes
+        to the same timestamp and open cursors stay valid. Only if the live records and the
+        new one span more than 45 days is the ring cleared.
+        """
+        buffer = self.buffer
+        record_size = self.record_size
+        oldest = 65535
+        for i in range(self.count):
+            relative_minutes = struct.unpack_from('<H', buffer, ((self.tail + i) % self.max_readings) * record_size)[0]
+            if relative_minutes < oldest:
+                oldest = relative_minutes
+        
+        if not self.count or int((timestamp - self.start_time) / 60) - oldest > 65535:
+            if self.count:
+                print("Clearing ring buffer (records would span more than 45 days)")
+                self.clear_all_data()
+            self.start_time = timestamp
+            return
+        
+        print(f"Rebasing time reference by {oldest} minutes (45-day limit reached)")
+        self.start_time += oldest * 60
+        for i in range(self.count):
+            offset = ((self.tail + i) % self.max_readings) * record_size
+            struct.pack_into('<H', buffer, offset, struct.unpack_from('<H', buffer, offset)[0] - oldest)
     
     def _parse_record(self, record_data):
         """Parse a single record from binary data"""
@@ -471,6 +685,84 @@ class TemperatureLogger:
         except (struct.error, IndexError):
             return None
     
+    def _sensor_name(self, sensor_id):
+        """Resolve a stored sensor ID to its name"""
+        sensor_name = self.sensor_names[sensor_id] if sensor_id < len(self.sensor_names) else None
+        if sensor_name is None:
+            sensor_name = f"unknown_{sensor_id}"
+        return sensor_name
+    
+    def cursor(self, reverse=False, sensor_name=None, start_seq=None):
+        """
+        Open a snapshot-consistent cursor over the stored records - NON-DESTRUCTIVE
+        
+        Args:
+            reverse: Iterate newest to oldest instead of oldest to newest
+            sensor_name: Only return records for this sensor (None for all)
+            start_seq: Forward cursors only - skip records older than this sequence number
+        
+        Returns:
+            HistoryCursor yielding (seq, timestamp, sensor_id, temperature),
+            or None if sensor_name is not registered
+        """
+        sensor_id = None
+        if sensor_name is not None:
+            if sensor_name not in self.name_to_id:
+                return None
+            sensor_id = self.name_to_id[sensor_name]
+        return HistoryCursor(self, reverse, sensor_id, start_seq=start_seq)
+    
+    def sync_cursor(self, seq):
+        """Opaque resume token for a sequence number, valid for this boot and ring epoch"""
+        return f"{self.boot_id:x}.{self.ring_epoch:x}.{seq:x}"
+    
+    def parse_sync_cursor(self, token):
+        """
+        Sequence number from a sync_cursor() token
+        
+        Returns:
+            The sequence number, or None if the token was issued before a reboot, clear or
+            time reset (the client has to resynchronise from scratch)
+        
+        Raises:
+            ValueError: If the token is malformed
+        """
+        parts = token.split('.')
+        if len(parts) != 3:
+            raise ValueError("Invalid cursor")
+        boot_id, ring_epoch, seq = int(parts[0], 16), int(parts[1], 16), int(parts[2], 16)
+        if boot_id != self.boot_id or ring_epoch != self.ring_epoch or seq > self.append_seq:
+            return None
+        return seq
+    
+    def sync_resume_seq(self, sensor_ids, end_seq):
+        """
+        Where the next incremental sync has to start after sending everything before end_seq
+        
+        A sensor's newest record keeps being updated in place for min_interval_minutes after
+        it was stored, so the resume point is moved back to any such open record. Clients
+        replace records they already hold by sequence number.
+        
+        Args:
+            sensor_ids: Sensor IDs the client follows (None for all)
+            end_seq: Sequence number just past the last record sent
+        """
+        current_time = time.time()
+        if sensor_ids is None:
+            sensor_ids = range(self.next_sensor_id)
+        resume = end_seq
+        for sensor_id in sensor_ids:
+            if self.sensor_names[sensor_id] is None:
+                continue
+            if current_time - self.last_stored_time_array[sensor_id] >= self.min_interval_seconds:
+                continue
+            # Same bounded search _update_existing_reading uses to find the record it updates
+            for seq, _, _, _ in HistoryCursor(self, reverse=True, sensor_id=sensor_id, max_scan=50):
+                if seq < resume:
+                    resume = seq
+                break
+        return resume
+    
     def _get_records_in_range(self, max_age_seconds=None, max_count=None):
         """
         Get records from ring buffer - NON-DESTRUCTIVE
@@ -485,65 +777,210 @@ class TemperatureLogger:
         if self.count == 0:
             return []
         
-        current_time = time.time()
-        
         if max_age_seconds is not None:
-            cutoff_time = current_time - max_age_seconds
+            cutoff_time = time.time() - max_age_seconds
         else:
             cutoff_time = 0  # Include all records if no age limit
         
-        # OPTIMIZED: Reuse list instead of creating new one
-        self._temp_records.clear()
-        
-        # Scan all records in the ring buffer
-        pos = self.tail
-        for i in range(self.count):
-            start_byte = pos * self.record_size
-            end_byte = start_byte + self.record_size
-            record_data = self.buffer[start_byte:end_byte]
-            
-            parsed = self._parse_record(record_data)
-            if parsed:
-                timestamp, sensor_name, temperature = parsed
-                
-                # Include if within time window
-                if timestamp >= cutoff_time:
-                    self._temp_records.append((timestamp, sensor_name, temperature))
-            
-            pos = (pos + 1) % self.max_readings
+        # Each call builds its own list so concurrent callers never share state
+        records = []
+        for seq, timestamp, sensor_id, temperature in HistoryCursor(self):
+            if timestamp >= cutoff_time:
+                records.append((timestamp, self._sensor_name(sensor_id), temperature))
         
         # Sort by timestamp (chronological order)
-        self._temp_records.sort(key=lambda x: x[0])
+        records.sort(key=lambda x: x[0])
         
         # Return most recent records if count limit specified
-        if max_count and len(self._temp_records) > max_count:
-            return self._temp_records[-max_count:]
+        if max_count and len(records) > max_count:
+            return records[-max_count:]
         
-        return self._temp_records.copy()  # Return copy for safety
+        return records
     
-    def get_all_current_temps(self, max_age_minutes=60):
+    def query(self, sensors=None, since=None, until=None, step=None, aggregates=('last',)):
         """
-        Get current temperatures from all sensors - NON-DESTRUCTIVE
+        Answer filter/resample/aggregate queries in a single pass - NON-DESTRUCTIVE
+        
+        Memory is bounded by the number of (sensor, bucket) pairs that actually
+        contain records, so it never exceeds the number of records in the ring.
+        
+        Args:
+            sensors: Iterable of sensor names to include (None for all sensors)
+            since: Only include records with timestamp >= since (None for no limit)
+            until: Only include records with timestamp < until (None for no limit)
+            step: Bucket width in seconds, aligned to multiples of step (None for one bucket)
+            aggregates: Names from QUERY_AGGREGATES to compute for each bucket
         
         Returns:
-            Dict: {sensor_name: temperature}
+            step is None: Dict {sensor_name: {aggregate: value}}
+            otherwise:    Dict {sensor_name: [(bucket_start, {aggregate: value}), ...]}
         """
-        max_age_seconds = max_age_minutes * 60
+        for aggregate in aggregates:
+            if aggregate not in QUERY_AGGREGATES:
+                raise ValueError(f"Unknown aggregate '{aggregate}'")
+        if step is not None and step <= 0:
+            raise ValueError("step must be positive")
+        
+        wanted = None
+        if sensors is not None:
+            wanted = set()
+            for sensor_name in sensors:
+                if sensor_name in self.name_to_id:
+                    wanted.add(self.name_to_id[sensor_name])
+            if not wanted:
+                return {}
+        
+        # sensor_id -> accumulator (no step) or {bucket: accumulator}
+        # Accumulator: [count, sum, min, max, first_ts, first, last_ts, last]
+        accumulators = {}
+        
+        for seq, timestamp, sensor_id, temperature in HistoryCursor(self):
+            if wanted is not None and sensor_id not in wanted:
+                continue
+            if since is not None and timestamp < since:
+                continue
+            if until is not None and timestamp >= until:
+                continue
+            
+            if step is None:
+                acc = accumulators.get(sensor_id)
+            else:
+                buckets = accumulators.get(sensor_id)
+                if buckets is None:
+                    buckets = accumulators[sensor_id] = {}
+                bucket = int(timestamp // step)
+                acc = buckets.get(bucket)
+            
+            if acc is None:
+                acc = [1, temperature, temperature, temperature, timestamp, temperature, timestamp, temperature]
+                if step is None:
+                    accumulators[sensor_id] = acc
+                else:
+                    buckets[bucket] = acc
+                continue
+            
+            acc[0] += 1
+            acc[1] += temperature
+            if temperature < acc[2]:
+                acc[2] = temperature
+            if temperature > acc[3]:
+                acc[3] = temperature
+            if timestamp < acc[4]:
+                acc[4] = timestamp
+                acc[5] = temperature
+            if timestamp >= acc[6]:
+                acc[6] = timestamp
+                acc[7] = temperature
+        
+        result = {}
+        for sensor_id, value in accumulators.items():
+            sensor_name = self._sensor_name(sensor_id)
+            
+            if step is None:
+                result[sensor_name] = self._finish_aggregates(value, aggregates)
+            else:
+                result[sensor_name] = [(bucket * step, self._finish_aggregates(value[bucket], aggregates))
+                                       for bucket in sorted(value)]
         
-        # Get records from ring buffer
-        recent_records = self._get_records_in_range(max_age_seconds)
+        return result
+    
+    def resample_grid(self, sensors, start, step, slots, aggregate='last'):
+        """
+        Resample records onto a dense fixed time grid in a single pass - NON-DESTRUCTIVE
         
-        if not recent_records:
-            return {}
+        Args:
+            sensors: Iterable of sensor names (None for all registered sensors)
+            start: Timestamp of the first slot
+            step: Slot width in seconds
+            slots: Number of slots in the grid
+            aggregate: 'last', 'avg', 'min' or 'max' for slots holding several records
         
-        # Find latest reading per sensor
-        latest_by_sensor = {}
-        for timestamp, sensor_name, temperature in recent_records:
-            if (sensor_name not in latest_by_sensor or 
-                timestamp > latest_by_sensor[sensor_name][0]):
-                latest_by_sensor[sensor_name] = (timestamp, temperature)
+        Returns:
+            Dict: {sensor_name: [value or None, ...]} with exactly `slots` entries per sensor
+        """
+        if aggregate not in ('last', 'avg', 'min', 'max'):
+            raise ValueError(f"Unknown aggregate '{aggregate}'")
+        if step <= 0 or slots <= 0:
+            raise ValueError("step and slots must be positive")
+        
+        if sensors is None:
+            sensors = self.get_sensor_names()
+        
+        # sensor_id -> value grid (and count grid for averages)
+        grids = {}
+        counts = {}
+        for sensor_name in sensors:
+            if sensor_name in self.name_to_id:
+                sensor_id = self.name_to_id[sensor_name]
+                grids[sensor_id] = [None] * slots
+                if aggregate == 'avg':
+                    counts[sensor_id] = [0] * slots
+        
+        end = start + step * slots
+        # A sensor's records are appended in time order, so the cursor's order
+        # makes 'last' simply the final record seen for a slot
+        for seq, timestamp, sensor_id, temperature in HistoryCursor(self):
+            grid = grids.get(sensor_id)
+            if grid is None or timestamp < start or timestamp >= end:
+                continue
+            
+            index = int((timestamp - start) // step)
+            current = grid[index]
+            if current is None or aggregate == 'last':
+                grid[index] = temperature
+            elif aggregate == 'avg':
+                grid[index] = current + temperature
+            elif aggregate == 'min':
+                if temperature < current:
+                    grid[index] = temperature
+            elif temperature > current:
+                grid[index] = temperature
+            
+            if aggregate == 'avg':
+                counts[sensor_id][index] += 1
+        
+        result = {}
+        for sensor_id, grid in grids.items():
+            if aggregate == 'avg':
+                count = counts[sensor_id]
+                for i in range(slots):
+                    if grid[i] is not None:
+                        grid[i] = round(grid[i] / count[i], 2)
+            result[self._sensor_name(sensor_id)] = grid
         
-        return {name: temp for name, (_, temp) in latest_by_sensor.items()}
+        return result
+    
+    def _finish_aggregates(self, acc, aggregates):
+        """Turn a query accumulator into {aggregate: value}"""
+        values = {}
+        for aggregate in aggregates:
+            if aggregate == 'count':
+                values['count'] = acc[0]
+            elif aggregate == 'sum':
+                values['sum'] = round(acc[1], 2)
+            elif aggregate == 'avg':
+                values['avg'] = round(acc[1] / acc[0], 2)
+            elif aggregate == 'min':
+                values['min'] = acc[2]
+            elif aggregate == 'max':
+                values['max'] = acc[3]
+            elif aggregate == 'first':
+                values['first'] = acc[5]
+            elif aggregate == 'last':
+                values['last'] = acc[7]
+            elif aggregate == 'last_ts':
+                values['last_ts'] = acc[6]
+        return values
+    
+    def get_all_current_temps(self, max_age_minutes=60):
+        """
+        Get current temperatures from all sensors - NON-DESTRUCTIVE
+        
+        Returns:
+            Dict: {sensor_name: temperature}
+        """
+        latest = self.query(since=time.time() - max_age_minutes * 60, aggregates=('last',))
+        return {name: values['last'] for name, values in latest.items()}
     
     def get_daily_records_by_sensor(self, hours=24):
         """
@@ -590,25 +1027,16 @@ class TemperatureLogger:
         Returns:
             Dict: {sensor_name: {'temperature': temp, 'timestamp': ts, 'age_minutes': age}}
         """
-        max_age_seconds = max_age_minutes * 60
         current_time = time.time()
+        latest = self.query(since=current_time - max_age_minutes * 60, aggregates=('last', 'last_ts'))
         
-        recent_records = self._get_records_in_range(max_age_seconds)
-        
-        if not recent_records:
-            return {}
-        
-        # Find latest reading per sensor with metadata
         latest_by_sensor = {}
-        for timestamp, sensor_name, temperature in recent_records:
-            if (sensor_name not in latest_by_sensor or 
-                timestamp > latest_by_sensor[sensor_name]['timestamp']):
-                age_minutes = (current_time - timestamp) / 60
-                latest_by_sensor[sensor_name] = {
-                    'temperature': temperature,
-                    'timestamp': timestamp,
-                    'age_minutes': round(age_minutes, 1)
-                }
+        for sensor_name, values in latest.items():
+            latest_by_sensor[sensor_name] = {
+                'temperature': values['last'],
+                'timestamp': values['last_ts'],
+                'age_minutes': round((current_time - values['last_ts']) / 60, 1)
+            }
         
         return latest_by_sensor
     
@@ -619,24 +1047,19 @@ class TemperatureLogger:
         Returns:
             Dict: {sensor_name: {'count': N, 'min': temp, 'max': temp, 'avg': temp, 'latest': temp}}
         """
-        daily_records = self.get_daily_records_by_sensor(hours)
-        summary = {}
         current_time = time.time()
+        stats = self.query(since=current_time - hours * 3600,
+                           aggregates=('count', 'min', 'max', 'avg', 'last', 'last_ts'))
+        summary = {}
         
-        for sensor_name, readings in daily_records.items():
-            if not readings:
-                continue
-                
-            temps = [temp for _, temp in readings]
-            latest_timestamp, latest_temp = readings[-1]
-            
+        for sensor_name, values in stats.items():
             summary[sensor_name] = {
-                'count': len(temps),
-                'min': min(temps),
-                'max': max(temps),
-                'avg': round(sum(temps) / len(temps), 2),
-                'latest': latest_temp,
-                'latest_age_minutes': round((current_time - latest_timestamp) / 60, 1),
+                'count': values['count'],
+                'min': values['min'],
+                'max': values['max'],
+                'avg': values['avg'],
+                'latest': values['last'],
+                'latest_age_minutes': round((current_time - values['last_ts']) / 60, 1),
                 'hours_covered': hours
             }
         
@@ -680,6 +1103,7 @@ class TemperatureLogger:
             'sensor_count': active_sensors,
             'detailed_readings_count': active_detailed,
             'sensor_slots_used': f"{active_sensors}/{self.max_sensors}",
+            'recycled_ids_free': len(self.free_sensor_ids),
             'max_records_per_sensor': self.max_records_per_sensor,
             'days_running': round((time.time() - self.start_time) / 86400, 2),
             'is_buffer_full': self.count >= self.max_readings,
@@ -716,24 +1140,13 @@ class TemperatureLogger:
             return {}
         
         # Count records per sensor
-        sensor_counts = {}
-        pos = self.tail
+        id_counts = {}
+        for seq, timestamp, sensor_id, temperature in HistoryCursor(self):
+            id_counts[sensor_id] = id_counts.get(sensor_id, 0) + 1
         
-        for i in range(self.count):
-            start_byte = pos * self.record_size
-            record_data = self.buffer[start_byte:start_byte + self.record_size]
-            
-            try:
-                _, sensor_id, _ = struct.unpack('<HBh', record_data)
-                # Use array lookup
-                sensor_name = self.sensor_names[sensor_id] if sensor_id < len(self.sensor_names) else f"unknown_{sensor_id}"
-                if sensor_name is None:
-                    sensor_name = f"unknown_{sensor_id}"
-                sensor_counts[sensor_name] = sensor_counts.get(sensor_name, 0) + 1
-            except:
-                pass
-            
-            pos = (pos + 1) % self.max_readings
+        sensor_counts = {}
+        for sensor_id, count in id_counts.items():
+            sensor_counts[self._sensor_name(sensor_id)] = count
         
         active_sensors = len([n for n in self.sensor_names[:self.next_sensor_id] if n is not None])
         
@@ -767,7 +1180,7 @@ class TemperatureLogger:
             print(f"Warning: Buffer nearly full - oldest data being overwritten")
     
     def export_csv(self, count=1000):
-        """Export recent data as CSV string - NON-DESTRUCTIVE"""
+        """Export recent data as CSV string - NON-DESTRUCTIVE (builds it all in RAM; /api/export streams instead)"""
         readings = self.get_recent_readings(count)
         
         csv_lines = ["timestamp,sensor_name,temperature"]
@@ -794,29 +1207,51 @@ class TemperatureLogger:
     
     def stream_history_reverse(self, sensor_name, max_readings=288):
         # Stream sensor history in reverse chronological order to avoid having to allocate a buffer for sorting
-        # Use a generator to yield results one by one
-        if sensor_name not in self.name_to_id:
-            return
-        
-        sensor_id = self.name_to_id[sensor_name]
+        # Use a generator to yield results one by one. The cursor is created up front so the
+        # snapshot is taken at call time, and it stays safe across awaits in the caller.
+        cursor = self.cursor(reverse=True, sensor_name=sensor_name)
+        if cursor is None:
+            return iter(())
+        return self._stream_cursor(cursor, max_readings)
+    
+    def _stream_cursor(self, cursor, max_readings):
         yielded_count = 0
-        pos = (self.head - 1) % self.max_readings
-        
-        for i in range(self.count):
+        for seq, timestamp, sensor_id, temperature in cursor:
             if yielded_count >= max_readings:
                 break
-                
-            start_byte = pos * self.record_size
-            record_data = self.buffer[start_byte:start_byte + self.record_size]
-            
-            parsed = self._parse_record(record_data)
-            if parsed:
-                timestamp, record_sensor_name, temperature = parsed
-                if record_sensor_name == sensor_name:
-                    yield timestamp, temperature
-                    yielded_count += 1
-            
-            pos = (pos - 1) % self.max_readings
+            yield timestamp, temperature
+            yielded_count += 1
+
+    def record_views(self):
+        """
+        Memoryviews over the stored records, oldest first - NON-DESTRUCTIVE, no copies
+
+        Returns:
+            List of one view, or two when the stored records wrap around the end of the ring.
+            Records are '<HBh' (minutes since start_time, sensor_id, temperature * 100).
+        """
+        if self.count == 0:
+            return []
+        start = self.tail * self.record_size
+        if self.tail + self.count <= self.max_readings:
+            return [self.view[start:start + self.count * self.record_size]]
+        return [self.view[start:], self.view[:self.head * self.record_size]]
+
+    def stream_history(self, sensor_name, since=None, until=None):
+        # Stream sensor history oldest first, since <= timestamp < until, one record at a time.
+        # As with stream_history_reverse the cursor is created up front.
+        cursor = self.cursor(sensor_name=sensor_name)
+        if cursor is None:
+            return iter(())
+        return self._stream_range(cursor, since, until)
+
+    def _stream_range(self, cursor, since, until):
+        for seq, timestamp, sensor_id, temperature in cursor:
+            if since is not None and timestamp < since:
+                continue
+            if until is not None and timestamp >= until:
+                break
+            yield timestamp, temperature
 
     def sensor_exists(self, sensor_name):
         """Check if a sensor has been registered"""
@@ -827,6 +1262,8 @@ class TemperatureLogger:
         self.head = 0
         self.tail = 0
         self.count = 0
+        self.ring_epoch += 1  # Ends any open cursors
+        self.generation += 1
         # Clear array-based storage
         for i in range(self.next_sensor_id):
             self.last_stored_time_array[i] = 0.0
@@ -844,7 +1281,9 @@ class TemperatureLogger:
         self.id_to_name.clear()
         for i in range(self.next_sensor_id):
             self.sensor_names[i] = None
+            self.sensor_generations[i] = (self.sensor_generations[i] + 1) & 0xFF
         self.next_sensor_id = 0
+        self.free_sensor_ids = []
         print("All data and sensor registrations cleared")
     
     def get_sensor_history(self, sensor_name, max_readings=200):
@@ -866,23 +1305,19 @@ class TemperatureLogger:
     
     def get_sensor_stats(self, sensor_name, hours=24):
         """Get statistics for a sensor over specified hours"""
-        history = self.get_sensor_history(sensor_name, 2000)
-        
-        if not history:
-            return None
-        
-        cutoff_time = time.time() - (hours * 3600)
-        recent_temps = [temp for ts, temp in history if ts >= cutoff_time]
+        stats = self.query(sensors=(sensor_name,), since=time.time() - (hours * 3600),
+                           aggregates=('count', 'min', 'max', 'avg'))
+        values = stats.get(sensor_name)
         
-        if not recent_temps:
+        if not values:
             return None
         
         return {
             'sensor_name': sensor_name,
-            'count': len(recent_temps),
-            'min': min(recent_temps),
-            'max': max(recent_temps),
-            'avg': sum(recent_temps) / len(recent_temps),
+            'count': values['count'],
+            'min': values['min'],
+            'max': values['max'],
+            'avg': values['avg'],
             'hours': hours
         }
     
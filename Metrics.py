@@ -0,0 +1,174 @@
+# Prometheus text exposition (format 0.0.4) of the live state, served at /metrics
+#
+# Nothing is collected in the background apart from a few counters and the event-loop lag
+# probe: every scrape reads the live objects and writes one sample line at a time to the
+# response writer, so no document is ever built in RAM. The # HELP / # TYPE preambles are
+# encoded once at import.
+import asyncio
+import gc
+import time
+
+try:
+    import esp32  # Largest free block per heap region; only on ESP32 ports
+except ImportError:
+    esp32 = None
+
+METRICS_CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+def family(name, kind, help_text):
+    return f"# HELP {name} {help_text}\n# TYPE {name} {kind}\n".encode()
+
+# Live sensor table (Data.sensor_data) gauges: (table field, metric name)
+SENSOR_FIELDS = (
+    ('temperature', 'tempmon_sensor_temperature_celsius'),
+    ('humidity', 'tempmon_sensor_humidity_percent'),
+    ('battery', 'tempmon_sensor_battery_percent'),
+    ('rssi', 'tempmon_sensor_rssi_dbm'),
+)
+_SENSOR_FAMILIES = (
+    family('tempmon_sensor_temperature_celsius', 'gauge', 'Latest temperature reported by the sensor'),
+    family('tempmon_sensor_humidity_percent', 'gauge', 'Latest relative humidity reported by the sensor'),
+    family('tempmon_sensor_battery_percent', 'gauge', 'Latest battery level reported by the sensor'),
+    family('tempmon_sensor_rssi_dbm', 'gauge', 'Signal strength of the latest advert'),
+)
+_SENSOR_AGE = family('tempmon_sensor_age_seconds', 'gauge', 'Seconds since the sensor was last heard')
+_ADVERTS = family('tempmon_adverts_total', 'counter',
+                  'BLE adverts from candidate sensors by outcome (seen = all of them)')
+_MQTT = family('tempmon_mqtt_publish_total', 'counter', 'MQTT publishes by result')
+_LOGGER_RECORDS = family('tempmon_logger_records', 'gauge', 'Records held in the ring buffer')
+_LOGGER_CAPACITY = family('tempmon_logger_capacity_records', 'gauge', 'Ring buffer size in records')
+_LOGGER_SENSORS = family('tempmon_logger_sensors', 'gauge', 'Sensors registered with the logger')
+_LOGGER_APPENDS = family('tempmon_logger_appends_total', 'counter', 'Records ever appended to the ring buffer')
+_HEAP_FREE = family('tempmon_heap_free_bytes', 'gauge', 'Free MicroPython heap')
+_HEAP_LARGEST = family('tempmon_heap_largest_free_block_bytes', 'gauge',
+                       'Largest free block in the system data heap (ESP-IDF)')
+_LOOP_LAG = family('tempmon_loop_lag_seconds', 'gauge', 'How late the last event-loop probe woke up')
+_LOOP_LAG_MAX = family('tempmon_loop_lag_max_seconds', 'gauge', 'Worst event-loop probe lateness since boot')
+
+def _label(value):
+    # Label values escape backslash, double quote and newline
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Stats keys that only ever count up; write_stats() exposes them as counters
+HISTORY_COUNTERS = ('flushes', 'blocks_written', 'bytes_written', 'write_errors', 'coalesced_updates')
+ARCHIVE_COUNTERS = ('records_archived', 'compacted_raw', 'compacted_hourly', 'compaction_runs')
+
+async def write_stats(out, prefix, stats, counters=()):
+    """
+    Write a flat stats dict (e.g. WriteBehind.get_stats()) as one family per numeric key
+
+    Args:
+        out: Writer with an async write(bytes)
+        prefix: Metric name prefix, e.g. 'tempmon_history'
+        stats: {key: number}; other values are skipped
+        counters: Keys written as counters (named <prefix>_<key>_total); the rest are gauges
+    """
+    for key, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        if key in counters:
+            await out.write(f"# TYPE {prefix}_{key}_total counter\n{prefix}_{key}_total {value}\n".encode())
+        else:
+            await out.write(f"# TYPE {prefix}_{key} gauge\n{prefix}_{key} {value}\n".encode())
+
+class Metrics:
+    def __init__(self, logger, live_table=None, history=None, archive=None):
+        """
+        Counters without another home, the event-loop lag probe and the /metrics renderer
+
+        Args:
+            logger: TemperatureLogger (ring occupancy)
+            live_table: Data.sensor_data style dict {addr: {'name', 'temperature', ..., 'last_updated'}}
+            history: WriteBehind (or anything with get_stats()) for flash write-behind metrics
+            archive: Archive for flash storage metrics
+        """
+        self.logger = logger
+        self.live_table = live_table
+        self.history = history
+        self.archive = archive
+
+        # BLE ingest
+        self.adverts_seen = 0     # Adverts from candidate sensors
+        self.adverts_decoded = 0  # Parsed as BTHome v2 and passed on
+        self.adverts_deduped = 0  # Repeats of a packet ID already handled
+        self.adverts_dropped = 0  # Empty, not BTHome v2, or failed while handling
+
+        self.mqtt_published = 0
+        self.mqtt_failed = 0
+
+        self.loop_lag_ms = 0
+        self.loop_lag_max_ms = 0
+
+    async def run_lag_probe(self, interval_ms=1000):
+        """Background task: how much later than asked the event loop resumes a sleeping task"""
+        while True:
+            started = time.ticks_ms()
+            await asyncio.sleep_ms(interval_ms)
+            lag = max(0, time.ticks_diff(time.ticks_ms(), started) - interval_ms)
+            self.loop_lag_ms = lag
+            if lag > self.loop_lag_max_ms:
+                self.loop_lag_max_ms = lag
+
+    async def render(self, out, extra=None):
+        """
+        Write the exposition to out, one family at a time
+
+        Args:
+            out: Writer with an async write(bytes), e.g. femtoweb's ChunkedWriter
+            extra: Optional async callable(out) appending further families (web server stats)
+        """
+        await self._render_sensors(out)
+
+        await out.write(_ADVERTS)
+        await out.write(f'tempmon_adverts_total{{outcome="seen"}} {self.adverts_seen}\n'
+                        f'tempmon_adverts_total{{outcome="decoded"}} {self.adverts_decoded}\n'
+                        f'tempmon_adverts_total{{outcome="deduped"}} {self.adverts_deduped}\n'
+                        f'tempmon_adverts_total{{outcome="dropped"}} {self.adverts_dropped}\n'.encode())
+        await out.write(_MQTT)
+        await out.write(f'tempmon_mqtt_publish_total{{result="ok"}} {self.mqtt_published}\n'
+                        f'tempmon_mqtt_publish_total{{result="error"}} {self.mqtt_failed}\n'.encode())
+
+        logger = self.logger
+        await out.write(_LOGGER_RECORDS + f"tempmon_logger_records {logger.count}\n".encode())
+        await out.write(_LOGGER_CAPACITY + f"tempmon_logger_capacity_records {logger.max_readings}\n".encode())
+        await out.write(_LOGGER_SENSORS + f"tempmon_logger_sensors {len(logger.name_to_id)}\n".encode())
+        await out.write(_LOGGER_APPENDS + f"tempmon_logger_appends_total {logger.append_seq}\n".encode())
+
+        await out.write(_HEAP_FREE + f"tempmon_heap_free_bytes {gc.mem_free()}\n".encode())
+        if esp32 is not None:
+            largest = 0
+            for region in esp32.idf_heap_info(esp32.HEAP_DATA):
+                if region[2] > largest:
+                    largest = region[2]
+            await out.write(_HEAP_LARGEST + f"tempmon_heap_largest_free_block_bytes {largest}\n".encode())
+        await out.write(_LOOP_LAG + f"tempmon_loop_lag_seconds {self.loop_lag_ms / 1000}\n".encode())
+        await out.write(_LOOP_LAG_MAX + f"tempmon_loop_lag_max_seconds {self.loop_lag_max_ms / 1000}\n".encode())
+
+        if self.history is not None:
+            await write_stats(out, 'tempmon_history', self.history.get_stats(), HISTORY_COUNTERS)
+        if self.archive is not None:
+            # Cheap: the flash figures are cached by the archive's compaction pass
+            await write_stats(out, 'tempmon_archive', self.archive.get_storage_stats(), ARCHIVE_COUNTERS)
+        if extra is not None:
+            await extra(out)
+
+    async def _render_sensors(self, out):
+        table = self.live_table
+        if not table:
+            return
+        # Labels are formatted once per sensor and reused for every family
+        labels = [(addr, f'{{sensor="{_label(addr)}",name="{_label(info["name"] or "")}"}}')
+                  for addr, info in table.items()]
+        for (field, name), family in zip(SENSOR_FIELDS, _SENSOR_FAMILIES):
+            await out.write(family)
+            for addr, label in labels:
+                info = table.get(addr)
+                if info is not None and info[field] is not None:
+                    await out.write(f"{name}{label} {info[field]}\n".encode())
+
+        now = time.ticks_ms()
+        await out.write(_SENSOR_AGE)
+        for addr, label in labels:
+            info = table.get(addr)
+            if info is not None:
+                await out.write(f"tempmon_sensor_age_seconds{label} {time.ticks_diff(now, info['last_updated']) / 1000}\n".encode())
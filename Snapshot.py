@@ -0,0 +1,175 @@
+# Warm-restart snapshot of the TemperatureLogger and the live sensor table
+#
+# File layout:
+#   header  '<4sHH11I'  magic, version, record_size, max_readings, head, tail, count, append_seq,
+#                       start_time, saved_at, log_segment, log_offset, meta length, CRC32
+#   ring    the logger's ring buffer, byte for byte (read back with readinto, no copies)
+#   meta    JSON: sensor registry arrays, last detailed readings and the live sensor table
+#
+# The CRC covers the header (minus the CRC field), the ring and the meta. The file is written
+# to a temporary name and renamed over the old snapshot, so a power cut mid-write leaves the
+# previous snapshot intact.
+import json
+import os
+import struct
+import time
+from binascii import crc32
+
+from Logger import SensorReading
+
+SNAPSHOT_MAGIC = b'TMSS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = '<4sHH11I'
+SNAPSHOT_HEADER_SIZE = struct.calcsize(SNAPSHOT_HEADER)
+NO_LOG_POSITION = 0xFFFFFFFF
+
+def save_snapshot(logger, live_table=None, log_position=None, path='snapshot.bin'):
+    """
+    Write the logger state (and optionally the live sensor table) atomically
+
+    Args:
+        logger: TemperatureLogger to save
+        live_table: Data.sensor_data style dict {addr: {..., 'last_updated': ticks_ms}}
+        log_position: HistoryLog.position() matching this state, so boot can replay what follows
+        path: Snapshot file name
+
+    Returns:
+        Milliseconds taken
+    """
+    started = time.ticks_ms()
+    count = logger.next_sensor_id
+    now_ticks = time.ticks_ms()
+
+    detailed = []
+    for reading in logger.detailed_readings_array[:count]:
+        if reading is None:
+            detailed.append(None)
+        else:
+            detailed.append([reading.temperature, reading.humidity, reading.battery_level, reading.rssi,
+                             reading.voltage, reading.power, reading.last_updated])
+
+    live = {}
+    if live_table is not None:
+        for addr, info in live_table.items():
+            item = info.copy()
+            # ticks_ms restarts at boot, so store an age instead
+            item['last_updated'] = time.ticks_diff(now_ticks, info['last_updated'])
+            live[addr] = item
+
+    meta = json.dumps({
+        'next': count,
+        'free': logger.free_sensor_ids,
+        'names': logger.sensor_names[:count],
+        'stored': logger.last_stored_time_array[:count],
+        'counts': logger.sensor_record_counts[:count],
+        'generations': list(logger.sensor_generations[:count]),
+        'detailed': detailed,
+        'live': live
+    }).encode()
+
+    if log_position is None:
+        log_segment, log_offset = NO_LOG_POSITION, 0
+    else:
+        log_segment, log_offset = log_position
+
+    header = bytearray(SNAPSHOT_HEADER_SIZE)
+    struct.pack_into(SNAPSHOT_HEADER, header, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, logger.record_size,
+                     logger.max_readings, logger.head, logger.tail, logger.count, logger.append_seq,
+                     int(logger.start_time), int(time.time()), log_segment, log_offset, len(meta), 0)
+    crc = crc32(memoryview(header)[:SNAPSHOT_HEADER_SIZE - 4])
+    crc = crc32(logger.buffer, crc)
+    crc = crc32(meta, crc)
+    struct.pack_into('<I', header, SNAPSHOT_HEADER_SIZE - 4, crc)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(logger.buffer)
+        f.write(meta)
+    os.rename(tmp_path, path)
+
+    elapsed = time.ticks_diff(time.ticks_ms(), started)
+    print(f"Snapshot saved: {logger.count} records, {len(meta)} bytes meta, {elapsed}ms")
+    return elapsed
+
+def load_snapshot(logger, live_table=None, path='snapshot.bin'):
+    """
+    Restore a snapshot into a freshly created (empty) logger and live sensor table
+
+    The ring is read with readinto straight into logger.buffer. Nothing else is touched
+    until the CRC has been verified; an invalid snapshot leaves the logger empty.
+
+    Returns:
+        (segment, offset) log position saved with the snapshot (a position past every
+        segment if it was saved without one), or None if there is no usable snapshot,
+        in which case the whole log should be replayed
+    """
+    started = time.ticks_ms()
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(SNAPSHOT_HEADER_SIZE)
+            if len(header) != SNAPSHOT_HEADER_SIZE:
+                print("Snapshot: truncated header, ignoring")
+                return None
+            (magic, version, record_size, max_readings, head, tail, count, append_seq,
+             start_time, saved_at, log_segment, log_offset, meta_len, crc) = struct.unpack(SNAPSHOT_HEADER, header)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                print("Snapshot: unknown format, ignoring")
+                return None
+            if record_size != logger.record_size or max_readings != logger.max_readings:
+                print("Snapshot: ring size differs from this logger, ignoring")
+                return None
+
+            # The logger is still empty (count == 0), so a bad read here does no harm
+            if f.readinto(logger.buffer) != len(logger.buffer):
+                print("Snapshot: truncated ring, ignoring")
+                return None
+            meta = f.read(meta_len)
+    except OSError:
+        print("No snapshot found")
+        return None
+
+    check = crc32(memoryview(header)[:SNAPSHOT_HEADER_SIZE - 4])
+    check = crc32(logger.buffer, check)
+    check = crc32(meta, check)
+    if len(meta) != meta_len or check != crc:
+        print("Snapshot: CRC mismatch, ignoring")
+        return None
+
+    state = json.loads(meta)
+    sensor_count = state['next']
+
+    logger.head = head
+    logger.tail = tail
+    logger.count = count
+    logger.append_seq = append_seq
+    logger.start_time = start_time
+    logger.ring_epoch += 1
+    logger.generation += 1
+
+    logger.next_sensor_id = sensor_count
+    logger.free_sensor_ids = state['free']
+    logger.name_to_id.clear()
+    logger.id_to_name.clear()
+    for sensor_id in range(sensor_count):
+        sensor_name = state['names'][sensor_id]
+        logger.sensor_names[sensor_id] = sensor_name
+        logger.last_stored_time_array[sensor_id] = state['stored'][sensor_id]
+        logger.sensor_record_counts[sensor_id] = state['counts'][sensor_id]
+        logger.sensor_generations[sensor_id] = state['generations'][sensor_id]
+        detailed = state['detailed'][sensor_id]
+        logger.detailed_readings_array[sensor_id] = SensorReading(*detailed) if detailed is not None else None
+        if sensor_name is not None:
+            logger.name_to_id[sensor_name] = sensor_id
+            logger.id_to_name[sensor_id] = sensor_name
+
+    if live_table is not None:
+        now_ticks = time.ticks_ms()
+        for addr, info in state['live'].items():
+            info['last_updated'] = time.ticks_add(now_ticks, -info['last_updated'])
+            live_table[addr] = info
+
+    elapsed = time.ticks_diff(time.ticks_ms(), started)
+    print(f"Snapshot restored: {count} records, {sensor_count} sensors, saved {int(time.time()) - saved_at}s ago, {elapsed}ms")
+
+    return (log_segment, log_offset)
@@ -0,0 +1,31 @@
+# femtoweb request-handling checks - run with the MicroPython unix port: micropython TestFemtoweb.py
+from femtoweb import _accepts_gzip
+
+def test_accept_encoding():
+    cases = (
+        (None, False),
+        (b"", False),
+        (b"gzip", True),
+        (b"gzip, deflate, br", True),
+        (b"deflate, GZIP", True),
+        (b"x-gzip", True),
+        (b"gzip;q=0", False),
+        (b"gzip; q=0.0, deflate", False),
+        (b"br, gzip;q=0.5", True),
+        (b"gzip;q=bogus", False),
+        (b"identity", False),
+        (b"*", True),
+        (b"*;q=0", False),
+        (b"*, gzip;q=0", False),
+        (b"gzip;q=0, *", False),
+        (b"notgzip", False),
+    )
+    for header, expected in cases:
+        assert _accepts_gzip(header) == expected, header
+
+def run():
+    for test in (test_accept_encoding,):
+        test()
+        print("ok", test.__name__)
+
+run()
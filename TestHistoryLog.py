@@ -0,0 +1,69 @@
+# History log crash-recovery checks - run with the MicroPython unix port: micropython TestHistoryLog.py
+import os
+
+from HistoryLog import HistoryLog
+from Logger import TemperatureLogger
+
+TEST_DIR = "hist_test"
+
+class FailingFile:
+    """Wraps a segment file; the next `failures` writes raise OSError as a full or worn flash would"""
+    def __init__(self, file, failures=1):
+        self.file = file
+        self.failures = failures
+
+    def write(self, data):
+        if self.failures:
+            self.failures -= 1
+            raise OSError(28)  # ENOSPC
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def clean():
+    try:
+        for name in os.listdir(TEST_DIR):
+            os.remove(f"{TEST_DIR}/{name}")
+        os.rmdir(TEST_DIR)
+    except OSError:
+        pass
+
+def new_logger():
+    logger = TemperatureLogger(max_readings=100, min_interval_minutes=1)
+    logger.start_time = 0
+    return logger
+
+def test_recover_after_failed_flush():
+    clean()
+    log = HistoryLog(TEST_DIR, block_size=64)
+    log.recover(new_logger())
+
+    # The failed block carried the sensor declarations for "a" and "b"
+    log.on_record(0, 0, "a", 600, 20.5)
+    log.on_record(0, 1, "b", 600, 5.0)
+    log.file = FailingFile(log.file)
+    assert log.flush() == 0
+    assert log.write_errors == 1
+
+    # Later records for the same sensors must still be recoverable
+    log.on_record(0, 0, "a", 1200, 21.0)
+    log.on_record(0, 1, "b", 1200, 5.5)
+    assert log.flush() > 0
+    log.close()
+
+    logger = new_logger()
+    replayed = HistoryLog(TEST_DIR, block_size=64).recover(logger)
+    assert replayed == 2, replayed
+    assert [(timestamp, temperature) for _, timestamp, _, temperature in logger.cursor()] == [(1200, 21.0), (1200, 5.5)]
+    clean()
+
+def run():
+    for test in (test_recover_after_failed_flush,):
+        test()
+        print("ok", test.__name__)
+
+run()
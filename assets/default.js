@@ -0,0 +1,51 @@
+// Decoder for /api/history?format=bin (see HISTORY_BIN_HEADER in femtoweb.py)
+//
+// Layout, little-endian:
+//   header   "TMHB", u8 version (2), u8 record size, u32 base (Unix seconds), u16 record count, u16 sensor count
+//   sensors  from offset 14, per sensor id: u8 name length, name bytes (length 0 for an unused id)
+//   records  per record: u16 minutes since base, u8 sensor id, i16 temperature * 100
+//
+// Returns { base, sensors: [name|null], series: { name: [{ ts, te }] } } with each series oldest first.
+function decodeBinaryHistory(arrayBuffer) {
+    const view = new DataView(arrayBuffer);
+    const magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+    if (magic !== "TMHB" || view.getUint8(4) !== 2) {
+        throw new Error("Unknown binary history format");
+    }
+    const recordSize = view.getUint8(5);
+    const base = view.getUint32(6, true);
+    const count = view.getUint16(10, true);
+    const sensorCount = view.getUint16(12, true);
+
+    const decoder = new TextDecoder();
+    const sensors = [];
+    const series = {};
+    let offset = 14;
+    for (let id = 0; id < sensorCount; id++) {
+        const length = view.getUint8(offset);
+        offset += 1;
+        const name = length ? decoder.decode(new Uint8Array(arrayBuffer, offset, length)) : null;
+        offset += length;
+        sensors.push(name);
+        if (name !== null) {
+            series[name] = [];
+        }
+    }
+
+    for (let i = 0; i < count; i++, offset += recordSize) {
+        const name = sensors[view.getUint8(offset + 2)];
+        if (name) {
+            series[name].push({
+                ts: base + view.getUint16(offset, true) * 60,
+                te: view.getInt16(offset + 3, true) / 100
+            });
+        }
+    }
+    return { base, sensors, series };
+}
+
+async function fetchBinaryHistory() {
+    const response = await fetch("/api/history?format=bin");
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    return decodeBinaryHistory(await response.arrayBuffer());
+}
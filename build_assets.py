@@ -0,0 +1,37 @@
+# Host-side build step (CPython, not MicroPython): store a .gz variant next to each text asset
+#
+#   python build_assets.py [assets directory]
+#
+# femtoweb serves <name>.gz with Content-Encoding: gzip when the browser accepts it. Run this
+# after editing anything in assets/ and upload the .gz files with the rest; they are not
+# committed (see .gitignore). Output is deterministic (mtime 0), so unchanged assets keep
+# their ETag.
+import gzip
+import os
+import sys
+
+COMPRESSIBLE = ('.html', '.css', '.js', '.svg', '.ico', '.json', '.txt')
+MIN_SAVING = 64  # Bytes; smaller gains are not worth a second file on flash
+
+def build(directory='assets'):
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(COMPRESSIBLE):
+            continue
+        path = os.path.join(directory, name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        packed = gzip.compress(data, compresslevel=9, mtime=0)
+
+        gz_path = path + '.gz'
+        if len(packed) + MIN_SAVING > len(data):
+            if os.path.exists(gz_path):
+                os.remove(gz_path)  # A stale variant would be served instead of the new file
+            print(f"{name}: {len(data)} bytes, not worth compressing")
+            continue
+
+        with open(gz_path, 'wb') as f:
+            f.write(packed)
+        print(f"{name}: {len(data)} -> {len(packed)} bytes")
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else 'assets')
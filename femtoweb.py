@@ -1,17 +1,90 @@
 # Drop-in replacement for MicroPython web server with memory optimizations
 import asyncio
 import aioble
+import binascii
+import gc
+import hashlib
+import os
 import sys
 import uerrno
 import time
 import json
+import struct
+
+from Events import EVENT_READING
+from Metrics import METRICS_CONTENT_TYPE, family
 
 UTC_OFFSET = 10 * 60 * 60
 MICROPYTHON_EPOCH_OFFSET = 946684800  # Seconds between Unix epoch (1970) and MicroPython epoch (2000)
+DEFAULT_SENSOR = "a4:c1:38:da:5e:ca"
+GRID_STEPS = (300, 900, 3600)  # Allowed /api/grid resolutions: 5 min, 15 min, 1 hour
+MAX_GRID_SLOTS = 24 * 12 * 2
+EXPORT_CHUNK = 1400  # Chunk payload that fits one TCP segment on a 1500 byte MTU
+OUTPUT_BUFFER_SIZE = 1460         # Per-connection write coalescing buffer: one TCP segment (MSS) on a 1500 byte MTU
+HEADER_TIMEOUT_S = 5              # A request head must be complete this long after its first bytes arrive
+RESPONSE_TIMEOUT_S = 30           # A whole response must be written within this (push and bulk streams excepted)
+WRITE_STALL_S = 10                # Any write may wait this long for the socket, plus MIN_SEND_RATE time
+MIN_SEND_RATE = 512               # Bytes/second a client must keep reading at
+IDLE_TIMEOUT_S = 15               # Keep-alive connections are closed after this long without a request
+MAX_REQUESTS_PER_CONNECTION = 100 # Then the response carries Connection: close
+MAX_CONNECTIONS = 4               # Request/response sockets; beyond this an idle keep-alive socket is closed,
+                                  # or the new one is answered 503 (push streams have their own budget below)
+ADMIT_MEM_FLOOR = 48 * 1024       # New connections are refused below this much free heap (BLE scanning needs the rest)
+ROUTE_MEM_FLOOR = 64 * 1024       # Capped (expensive) routes are refused below this
+RETRY_AFTER_S = 2
+EVENT_CLIENTS = 3                 # Concurrent /api/events streams (on top of MAX_CONNECTIONS)
+STATUS_TICK_S = 1                 # Status events are pushed this often when nothing else happens
+WS_CLIENTS = 3                    # Concurrent /api/ws connections (on top of MAX_CONNECTIONS)
+WS_PING_S = 30                    # Idle WebSocket connections are pinged this often
+WS_MAX_MESSAGE = 512              # Largest client frame accepted (they only carry subscriptions)
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_CLOSE = b"\x88\x00"
+WS_CLOSE_PROTOCOL_ERROR = b"\x88\x02\x03\xea"  # Close with status 1002
+# Binary reading frame payload, little-endian, 11 bytes:
+#   sensor id (u8, announced per connection by a text frame {"sensor": id, "name": ...}),
+#   Unix time (u32), temperature * 100 (i16, -32768 if unknown), humidity * 100 (u16, 0xFFFF if unknown),
+#   battery % (u8, 0xFF if unknown), RSSI dBm (i8, -128 if unknown)
+WS_READING = '<BIhHBb'
+WS_READING_SIZE = 11
+# /api/history?format=bin: header, then the sensor table (per id: u8 name length + name, 0 for a
+# free id), then the logger's own 5-byte '<HBh' records (minutes since base, sensor id, temp * 100)
+HISTORY_BIN_HEADER = '<4sBBIHH'  # magic, version, record size, base (Unix time), record count, sensor count
+HISTORY_BIN_MAGIC = b"TMHB"
+HISTORY_BIN_VERSION = 2  # 2: sensor count widened to u16 (a full table has 256 ids)
+HISTORY_LIMIT = 1000  # Most records one incremental history response carries
+HISTORY_WINDOW_S = 24 * 3600  # What a sync without a since/cursor starts with
+HISTORY_WINDOW_STEP_S = 60    # That window moves in steps of this, so its responses can be cached
+REQUEST_BUFFER_SIZE = 1024        # Per connection; the request line and all headers must fit
+MAX_HEADERS = 32
+# Header values copied out of the request buffer - every other header is skipped in place
+WANTED_HEADERS = (b"connection", b"accept-encoding", b"if-none-match", b"upgrade", b"sec-websocket-key")
+ASSET_DIR = "assets"
+CONTENT_TYPES = {'.html': b"text/html", '.css': b"text/css", '.js': b"application/javascript",
+                 '.svg': b"image/svg+xml", '.png': b"image/png", '.ico': b"image/x-icon"}
+# Assets are not fingerprinted, so pages revalidate (a 304 is cheap) while the rest is cached for a week
+CACHE_PAGE = b"Cache-Control: no-cache\r\n"
+CACHE_STATIC = b"Cache-Control: public, max-age=604800\r\n"
+ASSET_CACHE_BYTES = 16 * 1024      # RAM budget for cached asset responses (head + body)
+ASSET_CACHE_MAX_FILE = 4096        # Larger files are always streamed from flash
+ASSET_CACHE_MEM_FLOOR = 32 * 1024  # Cached responses are dropped while gc.mem_free() is below this
+RESPONSE_CACHE_BYTES = 16 * 1024   # RAM budget for cached /api/history and /tempdata responses
+RESPONSE_CACHE_MAX_BODY = 12 * 1024  # Larger bodies are streamed (a day of one sensor's history fits)
+TEMPDATA_CACHE_S = 10              # /tempdata carries the current time, so its cache entries expire this often
 
 # OPTIMIZED: Pre-allocated buffers to avoid frequent allocations
 _file_buffer = bytearray(512)  # For file reading (larger chunks than original 64 bytes)
 _temp_dict = {}  # Reusable dictionary for JSON responses
+_open_connections = 0  # Request/response sockets, bounded by MAX_CONNECTIONS
+_push_streams = 0      # Sockets handed over to SSE/WebSocket streams, bounded by their route limits
+_idle = []             # Tasks of keep-alive connections waiting for their next request, longest idle first
+_route_active = {}  # Handler -> requests in progress, for routes registered with a limit
+_route_limits = {}  # Handler -> most concurrent requests allowed
+_rejected = {'connections': 0, 'memory': 0, 'route': 0}
+_evicted = 0  # Idle keep-alive connections closed to admit a new client
+# Prebuilt so turning a client away under memory pressure allocates nothing
+_BUSY_RESPONSE = (f"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n"
+                  f"Retry-After: {RETRY_AFTER_S}\r\nConnection: close\r\n\r\n").encode()
+_assets = {}  # Asset name -> Asset, built once at boot by load_assets()
 
 
 def get_time():
@@ -25,14 +98,852 @@ def get_time():
         '{:02d}h {:02d}m {:02d}s'.format(uptime_h, uptime_m, uptime_s),
     )
 
-routes = {}
+def unquote(s):
+    # Minimal percent-decoding for query string values (e.g. MAC addresses sent as a4%3Ac1%3A...)
+    if '%' not in s and '+' not in s:
+        return s
+    s = s.replace('+', ' ')
+    parts = s.split('%')
+    out = [parts[0]]
+    for part in parts[1:]:
+        try:
+            out.append(chr(int(part[:2], 16)) + part[2:])
+        except ValueError:
+            out.append('%' + part)
+    return ''.join(out)
+
+def parse_query(path):
+    # Split "/path?a=1&b=2" into ("/path", {"a": "1", "b": "2"})
+    if '?' not in path:
+        return path, {}
+    path, query = path.split('?', 1)
+    return path, parse_params(query)
+
+def parse_params(query):
+    # "a=1&b=2" -> {"a": "1", "b": "2"}
+    params = {}
+    for pair in query.split('&'):
+        if not pair:
+            continue
+        if '=' in pair:
+            key, value = pair.split('=', 1)
+        else:
+            key, value = pair, ''
+        params[unquote(key)] = unquote(value)
+    return params
+
+def _split_list(value):
+    # "a,b,,c" -> ["a", "b", "c"]; None/empty -> None
+    if not value:
+        return None
+    return [item for item in value.split(',') if item]
+
+def _to_logger_time(unix_value):
+    # Unix epoch string from a client -> MicroPython epoch seconds used by the logger
+    if unix_value is None or unix_value == '':
+        return None
+    return int(unix_value) - MICROPYTHON_EPOCH_OFFSET
+
+class App:
+    """Services shared by every request handler"""
+    __slots__ = ['logger', 'alerts', 'archive', 'events', 'metrics']
+
+    def __init__(self, logger, alerts=None, archive=None, events=None, metrics=None):
+        self.logger = logger
+        self.alerts = alerts
+        self.archive = archive
+        self.events = events
+        self.metrics = metrics
+
+class Connection:
+    """
+    One client socket. keep_alive decides whether it stays open after the current response.
+
+    Everything sent goes through the output buffer: small writes are coalesced until a full
+    segment's worth is ready, so a response head, its headers and many small records leave
+    as a few MSS-sized segments instead of one segment per write. drain() sends the rest.
+    """
+    __slots__ = ['reader', 'writer', 'keep_alive', 'requests', 'buffer', 'view', 'filled',
+                 'out', 'out_view', 'out_len', 'unsent', 'deadline', 'stream']
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.keep_alive = True
+        self.requests = 0           # Requests served on this socket so far
+        self.buffer = bytearray(REQUEST_BUFFER_SIZE)  # Request heads are read and parsed in here
+        self.view = memoryview(self.buffer)
+        self.filled = 0             # Bytes in buffer; anything left after a head is the next request
+        self.out = bytearray(OUTPUT_BUFFER_SIZE)
+        self.out_view = memoryview(self.out)
+        self.out_len = 0            # Bytes waiting in out
+        self.unsent = 0             # Bytes handed to the stream since it was last drained
+        self.deadline = None        # ticks_ms by which the current response must be written (None: no limit)
+        self.stream = False         # Counted in _push_streams rather than _open_connections
+
+    def write(self, data):
+        """
+        Queue data without waiting for the socket
+
+        The buffer is topped up and handed to the stream once it is full; a remainder of at
+        least a whole buffer goes to the stream as it is, without being copied here. Nothing
+        awaits, so writes from different tasks never interleave within each other.
+
+        Returns:
+            True if the stream was given data and should be drained
+        """
+        length = len(data)
+        size = OUTPUT_BUFFER_SIZE
+        if self.out_len + length <= size:
+            self.out_view[self.out_len:self.out_len + length] = data
+            self.out_len += length
+            return False
+        if self.out_len:
+            take = size - self.out_len
+            data = memoryview(data)
+            self.out_view[self.out_len:] = data[:take]
+            self.writer.write(self.out_view)  # The stream copies whatever the socket doesn't take
+            self.unsent += size
+            self.out_len = 0
+            data = data[take:]
+            length -= take
+        if length >= size:
+            self.writer.write(data)
+            self.unsent += length
+        else:
+            self.out_view[:length] = data
+            self.out_len = length
+        return True
+
+    async def awrite(self, data):
+        if self.write(data):
+            await self._wait_sent()
+
+    async def drain(self):
+        """Send everything buffered and wait for the socket to take it"""
+        if self.out_len:
+            self.writer.write(self.out_view[:self.out_len])
+            self.unsent += self.out_len
+            self.out_len = 0
+        await self._wait_sent()
+
+    async def _wait_sent(self):
+        # A client that stops reading, or reads slower than MIN_SEND_RATE, or whose response
+        # runs past its deadline is cut off here; handle() then closes the socket
+        timeout_ms = WRITE_STALL_S * 1000 + self.unsent * 1000 // MIN_SEND_RATE
+        if self.deadline is not None:
+            timeout_ms = min(timeout_ms, time.ticks_diff(self.deadline, time.ticks_ms()))
+            if timeout_ms <= 0:
+                raise ClientTimeout("response deadline")
+        try:
+            await asyncio.wait_for(self.writer.drain(), timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            raise ClientTimeout("client not reading")
+        self.unsent = 0
+
+class ChunkedWriter:
+    """Collects small writes into fixed-size HTTP/1.1 chunks (Transfer-Encoding: chunked)"""
+    __slots__ = ['writer', 'buffer', 'view', 'length']
+
+    def __init__(self, writer, size=EXPORT_CHUNK):
+        self.writer = writer
+        self.buffer = bytearray(size)  # Allocated once per response - memory stays constant
+        self.view = memoryview(self.buffer)
+        self.length = 0
+
+    async def write(self, data):
+        size = len(self.buffer)
+        while data:
+            take = min(len(data), size - self.length)
+            self.view[self.length:self.length + take] = data[:take]
+            self.length += take
+            data = data[take:]
+            if self.length == size:
+                await self._send_chunk()
+
+    async def flush(self):
+        """Send whatever is buffered now, as a short chunk (for pushed events)"""
+        await self._send_chunk()
+
+    def _queue_chunk(self):
+        # Size line, data and CRLF go into the connection's output buffer together
+        if self.length == 0:
+            return
+        self.writer.write(f"{self.length:x}\r\n".encode())
+        self.writer.write(self.view[:self.length])
+        self.writer.write(b"\r\n")
+        self.length = 0
+
+    async def _send_chunk(self):
+        if self.length == 0:
+            return
+        self._queue_chunk()
+        await self.writer.drain()
+
+    async def close(self):
+        # What is left and the terminating zero-length chunk share one segment where they fit
+        self._queue_chunk()
+        self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+def _response_head(conn, status, content_type=None, length=None, extra=b""):
+    # Every response is framed (Content-Length, or chunked when length is None) so the
+    # connection can carry the next request. A 304 has no body and no framing header.
+    # conn is None for heads that are cached and reused on any connection.
+    head = b"HTTP/1.1 " + status + b"\r\n"
+    if content_type is not None:
+        head += b"Content-Type: " + content_type + b"\r\n"
+    if status[:3] == b"304":
+        pass
+    elif length is None:
+        head += b"Transfer-Encoding: chunked\r\n"
+    else:
+        head += f"Content-Length: {length}\r\n".encode()
+    if conn is not None and not conn.keep_alive:
+        head += b"Connection: close\r\n"
+    return head + extra + b"\r\n"
+
+async def send_response(conn, status, content_type=None, body=b"", extra=b""):
+    # A complete response whose body is already in memory
+    await conn.awrite(_response_head(conn, status, content_type, len(body), extra))
+    if body:
+        await conn.awrite(body)
+    await conn.drain()
+
+async def start_chunked(conn, content_type, extra=b""):
+    # Send a 200 head for a streamed body; the caller writes to the returned ChunkedWriter and closes it
+    await conn.awrite(_response_head(conn, b"200 OK", content_type, None, extra))
+    return ChunkedWriter(conn)
+
+class Request:
+    """One parsed request head"""
+    __slots__ = ['method', 'path', 'params', 'path_params', 'headers', 'keep_alive']
+
+    def __init__(self):
+        self.method = None
+        self.path = None
+        self.params = None
+        self.path_params = None
+        self.headers = {}       # WANTED_HEADERS name -> raw value bytes
+        self.keep_alive = False
+
+class ClientTimeout(Exception):
+    """The client is too slow: it stopped reading, or its response ran past the deadline"""
+
+class RequestError(Exception):
+    """A request that can't be parsed within the limits; args[0] is the status to answer with"""
 
-#Route decorator - keeping original commented code
-'''def route(route):
+def _find_byte(buf, byte, start, end):
+    # bytearray.find is not available on every MicroPython port
+    for i in range(start, end):
+        if buf[i] == byte:
+            return i
+    return -1
+
+def _header_value(buf, start, end, name):
+    # Offset of the value if buf[start:end] is the header `name` (lowercase bytes), else -1.
+    # Compares in place, so headers nobody asked for are never decoded or copied.
+    length = len(name)
+    if end - start <= length or buf[start + length] != 58:  # ':'
+        return -1
+    for i in range(length):
+        c = buf[start + i]
+        if 65 <= c <= 90:
+            c += 32
+        if c != name[i]:
+            return -1
+    offset = start + length + 1
+    while offset < end and buf[offset] == 32:
+        offset += 1
+    return offset
+
+def _parse_request_line(view, start, end):
+    space = _find_byte(view, 32, start, end)
+    if space < 0:
+        raise RequestError(b"400 Bad Request")
+    target_end = _find_byte(view, 32, space + 1, end)
+    if target_end < 0:
+        target_end = end
+
+    request = Request()
+    request.method = 'GET' if view[start:space] == b"GET" else bytes(view[start:space]).decode()
+    query = _find_byte(view, 63, space + 1, target_end)  # '?'
+    if query < 0:
+        request.path = bytes(view[space + 1:target_end]).decode()
+        request.params = {}
+    else:
+        request.path = bytes(view[space + 1:query]).decode()
+        request.params = parse_params(bytes(view[query + 1:target_end]).decode())
+    request.keep_alive = view[target_end + 1:end] == b"HTTP/1.1"
+    return request
+
+async def read_request(reader, conn, timeout):
+    """
+    Read one request head into the connection's buffer and parse it
+
+    Only the request line and WANTED_HEADERS values are copied out of the buffer. Bytes
+    after the head (a pipelined request) stay buffered for the next call.
+
+    Args:
+        timeout: Seconds to wait for the first bytes (asyncio.TimeoutError when they don't come);
+            the whole head must then be in within HEADER_TIMEOUT_S, however it is trickled
+
+    Returns:
+        Request, or None if the client closed the connection
+    """
+    buf = conn.buffer
+    view = conn.view
+    request = None
+    line_start = 0
+    scan = 0
+    header_count = 0
+    # A pipelined request may already be (partly) buffered; its clock starts now
+    deadline = time.ticks_add(time.ticks_ms(), HEADER_TIMEOUT_S * 1000) if conn.filled else None
+
+    while True:
+        newline = _find_byte(buf, 10, scan, conn.filled)
+        if newline < 0:
+            if conn.filled == len(buf):
+                raise RequestError(b"414 URI Too Long" if request is None else b"431 Request Header Fields Too Large")
+            if deadline is not None:
+                timeout = time.ticks_diff(deadline, time.ticks_ms()) / 1000
+                if timeout <= 0:
+                    raise RequestError(b"408 Request Timeout")
+            try:
+                bytes_read = await asyncio.wait_for(reader.readinto(view[conn.filled:]), timeout)
+            except asyncio.TimeoutError:
+                if deadline is None:
+                    raise  # Nothing arrived: idle connection
+                raise RequestError(b"408 Request Timeout")
+            if not bytes_read:
+                return None
+            if deadline is None:
+                deadline = time.ticks_add(time.ticks_ms(), HEADER_TIMEOUT_S * 1000)
+            scan = conn.filled
+            conn.filled += bytes_read
+            continue
+
+        end = newline
+        if end > line_start and buf[end - 1] == 13:  # '\r'
+            end -= 1
+        scan = newline + 1
+
+        if request is None:
+            if end > line_start:  # Blank lines before a request are ignored
+                request = _parse_request_line(view, line_start, end)
+        elif end == line_start:
+            break  # End of the head
+        else:
+            header_count += 1
+            if header_count > MAX_HEADERS:
+                raise RequestError(b"431 Request Header Fields Too Large")
+            for name in WANTED_HEADERS:
+                offset = _header_value(buf, line_start, end, name)
+                if offset >= 0:
+                    request.headers[name] = bytes(view[offset:end])
+                    break
+        line_start = scan
+
+    remaining = conn.filled - scan
+    if remaining:
+        buf[:remaining] = buf[scan:conn.filled]
+    conn.filled = remaining
+
+    connection = request.headers.get(b"connection")
+    if connection is not None and b"close" in connection.lower():
+        request.keep_alive = False
+    return request
+
+_routes = {}      # Exact path -> handler
+_route_tree = {}  # Routes with parameters, by path segment: '<>' matches any segment, None holds (handler, names)
+_bulk_routes = set()  # Handlers streaming bodies of unbounded size - exempt from RESPONSE_TIMEOUT_S
+
+def route(pattern, limit=None, bulk=False):
+    """
+    Register handler(conn, request, app) for a path such as '/api/status' or '/api/history/<sensor>'
+
+    Args:
+        limit: Most requests this handler may run at once (None for no cap). Capped
+            handlers are also refused while free heap is below ROUTE_MEM_FLOOR.
+        bulk: The handler streams a body of unbounded size, so it gets no RESPONSE_TIMEOUT_S
+            deadline; only a client reading slower than WRITE_STALL_S/MIN_SEND_RATE cuts it off.
+    """
     def decorator(func):
-        routes[route] = func
+        if limit is not None:
+            _route_limits[func] = limit
+            _route_active[func] = 0
+        if bulk:
+            _bulk_routes.add(func)
+        if '<' not in pattern:
+            _routes[pattern] = func
+            return func
+        node = _route_tree
+        names = []
+        for segment in pattern.strip('/').split('/'):
+            if segment.startswith('<') and segment.endswith('>'):
+                names.append(segment[1:-1])
+                segment = '<>'
+            node = node.setdefault(segment, {})
+        node[None] = (func, names)
         return func
-    return decorator'''
+    return decorator
+
+def match_route(request):
+    # Exact routes cost one dict lookup; only paths that miss walk the parameter tree
+    handler = _routes.get(request.path)
+    if handler is not None:
+        return handler
+
+    node = _route_tree
+    values = []
+    for segment in request.path.strip('/').split('/'):
+        child = node.get(segment)
+        if child is None:
+            child = node.get('<>')
+            if child is None:
+                return None
+            values.append(unquote(segment))
+        node = child
+
+    entry = node.get(None)
+    if entry is None:
+        return None
+    handler, names = entry
+    request.path_params = dict(zip(names, values))
+    return handler
+
+class Asset:
+    """A static file under ASSET_DIR, with the validators computed at boot"""
+    __slots__ = ['path', 'size', 'etag', 'gz_size', 'content_type', 'cache_control']
+
+    def __init__(self, path, size, etag, gz_size, content_type, cache_control):
+        self.path = path
+        self.size = size
+        self.etag = etag            # Strong ETag of the identity file; the gzip variant appends -gz
+        self.gz_size = gz_size      # Size of path + '.gz', or None if there is no variant
+        self.content_type = content_type
+        self.cache_control = cache_control
+
+class ResponseCache:
+    """LRU cache of complete responses (preformatted head + body) under a byte budget"""
+    __slots__ = ['budget', 'max_file', 'mem_floor', 'entries', 'order', 'used', 'hits', 'misses', 'evictions']
+
+    def __init__(self, budget=ASSET_CACHE_BYTES, max_file=ASSET_CACHE_MAX_FILE, mem_floor=ASSET_CACHE_MEM_FLOOR):
+        """
+        Args:
+            budget: Most bytes held across all entries
+            max_file: Largest body worth caching
+            mem_floor: Evict (oldest first) whenever gc.mem_free() is below this
+        """
+        self.budget = budget
+        self.max_file = max_file
+        self.mem_floor = mem_floor
+        self.entries = {}   # key -> (bytearray of head + CRLF + body, length of head)
+        self.order = []     # Keys, least recently used first (a handful of entries, so a list is fine)
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, count=True):
+        """Entry for key or None; count=False for a repeat lookup that must not be counted again"""
+        entry = self.entries.get(key)
+        if entry is None:
+            if count:
+                self.misses += 1
+            return None
+        if count:
+            self.hits += 1
+        self.order.remove(key)
+        self.order.append(key)
+        self.trim()
+        return entry
+
+    def put(self, key, data, head_length):
+        if len(data) > self.budget:
+            return
+        while self.order and self.used + len(data) > self.budget:
+            self._evict()
+        self.entries[key] = (data, head_length)
+        self.order.append(key)
+        self.used += len(data)
+        self.trim()
+
+    def trim(self):
+        # Give RAM back to the rest of the system first - every entry can be rebuilt
+        while self.order and gc.mem_free() < self.mem_floor:
+            self._evict()
+
+    def _evict(self):
+        key = self.order.pop(0)
+        data, _ = self.entries.pop(key)
+        self.used -= len(data)
+        self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.order.clear()
+        self.used = 0
+
+_asset_cache = ResponseCache()
+# Logger-derived responses, keyed by (path, params, ETag); the ETag carries the logger generation
+_response_cache = ResponseCache(RESPONSE_CACHE_BYTES, RESPONSE_CACHE_MAX_BODY, ASSET_CACHE_MEM_FLOOR)
+_inflight = {}  # Response cache key -> asyncio.Event set when the request building it is done
+
+def _hash_file(path):
+    # SHA-256 of a file read through _file_buffer; returns (size, first 8 bytes as hex)
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            bytes_read = f.readinto(_file_buffer)
+            if bytes_read == 0:
+                break
+            digest.update(memoryview(_file_buffer)[:bytes_read])
+            size += bytes_read
+    return size, binascii.hexlify(digest.digest()[:8])
+
+def load_assets(directory=ASSET_DIR):
+    """Hash every asset once so requests can be answered with ETags and 304s without reading flash"""
+    _assets.clear()
+    _asset_cache.clear()
+    names = os.listdir(directory)
+    for name in names:
+        if name.endswith('.gz'):
+            continue  # Recorded as the variant of its source file
+        path = f"{directory}/{name}"
+        try:
+            size, digest = _hash_file(path)
+            gz_size = os.stat(path + '.gz')[6] if name + '.gz' in names else None
+        except OSError as e:
+            print(f"Asset {name} skipped: {e}")
+            continue
+        dot = name.rfind('.')
+        extension = name[dot:] if dot >= 0 else ''
+        _assets[name] = Asset(path, size, b'"' + digest + b'"', gz_size, CONTENT_TYPES.get(extension),
+                              CACHE_PAGE if extension == '.html' else CACHE_STATIC)
+    print(f"Assets loaded: {len(_assets)} files")
+
+def _etag_matches(if_none_match, etag):
+    # If-None-Match may list several ETags (weak ones compare equal for GET) or be "*"
+    if if_none_match is None:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == etag:
+            return True
+    return False
+
+def _accepts_gzip(accept_encoding):
+    # Accept-Encoding lists codings with optional q-values; q=0 refuses one, and "*" covers
+    # every coding not named (RFC 9110 12.5.3)
+    if accept_encoding is None:
+        return False
+    wildcard = False
+    for item in accept_encoding.split(b','):
+        parts = item.split(b';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param[:2].lower() == b'q=':
+                try:
+                    q = float(param[2:].decode())
+                except ValueError:
+                    q = 0.0
+        if coding == b'gzip' or coding == b'x-gzip':
+            return q > 0
+        if coding == b'*':
+            wildcard = q > 0
+    return wildcard
+
+async def _send_entry(conn, entry):
+    # A ResponseCache entry: (head + CRLF + body, length of head)
+    data, head_length = entry
+    view = memoryview(data)
+    if conn.keep_alive:
+        await conn.awrite(view)
+    else:
+        # The cached head is for a kept-alive connection - splice the close in before its blank line
+        await conn.awrite(view[:head_length])
+        await conn.awrite(b"Connection: close\r\n")
+        await conn.awrite(view[head_length:])
+    await conn.drain()
+
+class BodyWriter:
+    """
+    Collects a body in RAM for the response cache; same interface as ChunkedWriter
+
+    A body that outgrows limit is not rendered again: the writer releases requests waiting
+    on key (they render their own copy rather than wait for this client to read it all),
+    starts a chunked response on conn, sends what it collected so far and passes every
+    further write straight on.
+    """
+    __slots__ = ['buffer', 'limit', 'conn', 'content_type', 'extra', 'key', 'pending', 'out']
+
+    def __init__(self, limit, conn, content_type, extra, key, pending):
+        self.buffer = bytearray()
+        self.limit = limit
+        self.conn = conn
+        self.content_type = content_type
+        self.extra = extra
+        self.key = key          # Response cache key this body is being built for
+        self.pending = pending  # Its _inflight event
+        self.out = None  # ChunkedWriter once the body turned out too large to cache
+
+    async def write(self, data):
+        if self.out is not None:
+            await self.out.write(data)
+            return
+        if len(self.buffer) + len(data) > self.limit:
+            _end_inflight(self.key, self.pending)
+            self.out = await start_chunked(self.conn, self.content_type, self.extra)
+            collected = self.buffer
+            self.buffer = None
+            await self.out.write(collected)
+            await self.out.write(data)
+            return
+        self.buffer.extend(data)
+
+    async def flush(self):
+        if self.out is not None:
+            await self.out.flush()
+
+    async def close(self):
+        if self.out is not None:
+            await self.out.close()
+
+def _end_inflight(key, pending):
+    # Wake the requests waiting on pending; safe to call more than once, and once released
+    # it never touches a newer build of the same key
+    if _inflight.get(key) is pending:
+        del _inflight[key]
+    pending.set()
+
+async def send_cached(conn, request, etag, content_type, render):
+    """
+    Send a response whose body only changes with its ETag, sharing the work between clients
+
+    A matching If-None-Match gets a 304. Otherwise the body comes from _response_cache;
+    on a miss the first request builds it with render while concurrent requests for the
+    same key wait for that result instead of building their own. Bodies too large to
+    cache are streamed chunked to each client as they are rendered.
+
+    Args:
+        conn: Connection to answer on
+        request: Request; its path and params are part of the cache key
+        etag: Quoted ETag bytes that change whenever the body may (e.g. with the logger generation)
+        content_type: Content-Type bytes
+        render: async callable(out) writing the body to a ChunkedWriter-like out
+    """
+    extra = b"ETag: " + etag + b"\r\n" + CACHE_PAGE
+    if_none_match = request.headers.get(b"if-none-match")
+    if if_none_match is not None and _etag_matches(if_none_match.decode(), etag.decode()):
+        await send_response(conn, b"304 Not Modified", extra=extra)
+        return
+
+    params = request.params
+    key = (request.path, tuple(sorted(params.items())) if params else (), etag)
+    cached = _response_cache.get(key)
+    if cached is None:
+        pending = _inflight.get(key)
+        if pending is not None:
+            await pending.wait()
+            cached = _response_cache.get(key, count=False)  # Already counted as a miss above
+        else:
+            pending = _inflight[key] = asyncio.Event()
+            try:
+                body = BodyWriter(_response_cache.max_file, conn, content_type, extra, key, pending)
+                await render(body)
+                if body.out is not None:
+                    # Too large to cache - it has already been streamed to this client
+                    await body.close()
+                    return
+                head = _response_head(None, b"200 OK", content_type, len(body.buffer), extra)
+                data = bytearray(len(head) + len(body.buffer))
+                data[:len(head)] = head
+                data[len(head):] = body.buffer
+                body = None
+                cached = (data, len(head) - 2)
+                _response_cache.put(key, data, len(head) - 2)
+            finally:
+                _end_inflight(key, pending)
+
+    if cached is not None:
+        await _send_entry(conn, cached)
+        return
+
+    out = await start_chunked(conn, content_type, extra)
+    await render(out)
+    await out.close()
+
+async def send_asset(conn, request, name):
+    asset = _assets.get(name)
+    if asset is None:
+        print(name, "not found")
+        await send_response(conn, b"404 Not Found")
+        return
+
+    use_gzip = asset.gz_size is not None and _accepts_gzip(request.headers.get(b"accept-encoding"))
+    if use_gzip:
+        etag = asset.etag[:-1] + b'-gz"'
+        path, size = asset.path + '.gz', asset.gz_size
+    else:
+        etag = asset.etag
+        path, size = asset.path, asset.size
+    extra = b"ETag: " + etag + b"\r\n" + asset.cache_control
+    if asset.gz_size is not None:
+        extra += b"Vary: Accept-Encoding\r\n"
+
+    if_none_match = request.headers.get(b"if-none-match")
+    if if_none_match is not None and _etag_matches(if_none_match.decode(), etag.decode()):
+        await send_response(conn, b"304 Not Modified", extra=extra)
+        return
+
+    if use_gzip:
+        extra += b"Content-Encoding: gzip\r\n"
+
+    cache_key = name + '.gz' if use_gzip else name
+    cached = _asset_cache.get(cache_key)
+    if cached is None and size <= _asset_cache.max_file:
+        # Read once into a single buffer holding the whole response, then keep it
+        head = _response_head(None, b"200 OK", asset.content_type, size, extra)
+        head_length = len(head) - 2
+        data = bytearray(len(head) + size)
+        data[:len(head)] = head
+        try:
+            with open(path, 'rb') as f:
+                if f.readinto(memoryview(data)[len(head):]) != size:
+                    raise OSError(uerrno.EIO)
+        except OSError as e:
+            print("Error:", e.args[0])
+            await send_response(conn, b"500 Internal Server Error")
+            return
+        _asset_cache.put(cache_key, data, head_length)
+        cached = (data, head_length)
+
+    if cached is not None:
+        await _send_entry(conn, cached)
+        print("Sent", name)
+        return
+
+    try:
+        with open(path, 'rb') as f:
+            await conn.awrite(_response_head(conn, b"200 OK", asset.content_type, size, extra))
+
+            while True:
+                # OPTIMIZED: Use pre-allocated buffer for larger, more efficient reads
+                bytes_read = f.readinto(_file_buffer)
+
+                if bytes_read == 0:
+                    break
+
+                # Send only the bytes we actually read; the connection coalesces them into full segments
+                if bytes_read == len(_file_buffer):
+                    await conn.awrite(_file_buffer)
+                else:
+                    await conn.awrite(_file_buffer[:bytes_read])
+            await conn.drain()
+    except OSError as e:
+        print("Error:", e.args[0])
+        # The head may already be out - the body can't be completed, so don't reuse the socket
+        conn.keep_alive = False
+        return
+
+    print("Sent", name)
+
+@route('/api/query', limit=1, bulk=True)
+async def send_query(conn, request, app):
+    # GET /api/query?sensors=a,b&since=<unix>&until=<unix>&step=<seconds>&agg=min,max,avg
+    # All aggregates for all requested sensors come from one pass over the ring buffer
+    params = request.params
+    logger = app.logger
+    try:
+        step = int(params['step']) if params.get('step') else None
+        aggregates = _split_list(params.get('agg')) or ['last']
+        result = logger.query(sensors=_split_list(params.get('sensors')),
+                              since=_to_logger_time(params.get('since')),
+                              until=_to_logger_time(params.get('until')),
+                              step=step,
+                              aggregates=aggregates)
+    except ValueError as e:
+        await send_response(conn, b"400 Bad Request", b"application/json", json.dumps({"error": str(e)}).encode())
+        return
+
+    out = await start_chunked(conn, b"application/json")
+
+    # Stream one sensor at a time so we never build the whole document as one string
+    await out.write(f'{{"step":{json.dumps(step)},"sensors":{{'.encode())
+    first_sensor = True
+    for sensor_name, values in result.items():
+        if not first_sensor:
+            await out.write(b',')
+        first_sensor = False
+        await out.write(json.dumps(sensor_name).encode())
+        await out.write(b':')
+
+        if step is None:
+            if 'last_ts' in values:
+                values['last_ts'] = int(values['last_ts']) + MICROPYTHON_EPOCH_OFFSET
+            await out.write(json.dumps(values).encode())
+            continue
+
+        await out.write(b'[')
+        first_bucket = True
+        for bucket_start, bucket_values in values:
+            if not first_bucket:
+                await out.write(b',')
+            first_bucket = False
+            bucket_values['ts'] = int(bucket_start) + MICROPYTHON_EPOCH_OFFSET
+            if 'last_ts' in bucket_values:
+                bucket_values['last_ts'] = int(bucket_values['last_ts']) + MICROPYTHON_EPOCH_OFFSET
+            await out.write(json.dumps(bucket_values).encode())
+        await out.write(b']')
+
+    await out.write(b'}}')
+    await out.close()
+
+@route('/api/grid', limit=2)
+async def send_grid(conn, request, app):
+    # GET /api/grid?sensors=a,b&step=300&start=<unix>&slots=288&agg=last
+    # Dense fixed-grid series (null for gaps) so the browser does no binning
+    params = request.params
+    try:
+        step = int(params.get('step') or 300)
+        if step not in GRID_STEPS:
+            raise ValueError(f"step must be one of {GRID_STEPS}")
+        slots = int(params.get('slots') or (24 * 3600) // step)
+        if slots > MAX_GRID_SLOTS:
+            raise ValueError(f"slots must be <= {MAX_GRID_SLOTS}")
+        if params.get('start'):
+            start = int(params['start'])
+        else:
+            # Default: the last 24 hours, ending at the next step boundary
+            now = int(time.time()) + MICROPYTHON_EPOCH_OFFSET
+            start = (now // step + 1) * step - slots * step
+        sensors = _split_list(params.get('sensors')) or [DEFAULT_SENSOR]
+        grids = app.logger.resample_grid(sensors, start - MICROPYTHON_EPOCH_OFFSET, step, slots,
+                                     params.get('agg') or 'last')
+    except ValueError as e:
+        await send_response(conn, b"400 Bad Request", b"application/json", json.dumps({"error": str(e)}).encode())
+        return
+
+    out = await start_chunked(conn, b"application/json")
+    await out.write(f'{{"start":{start},"step":{step},"slots":{slots},"sensors":{{'.encode())
+
+    first_sensor = True
+    for sensor_name, grid in grids.items():
+        if not first_sensor:
+            await out.write(b',')
+        first_sensor = False
+        await out.write(json.dumps(sensor_name).encode())
+        await out.write(b':')
+        await out.write(json.dumps(grid).encode())
+
+    await out.write(b'}}')
+    await out.close()
 
 #route('/settings.html') - keeping original commented code
 async def index(mywriter):
@@ -105,173 +1016,711 @@ async def doodle(writer, filename):
         else:
             print("File Not Found")'''
 
-async def serve(writer, filename, logger):
-    print("Sending", filename)
-    
-    if filename == '/':
-        filename = 'index.html'
-    
-    #if filename.startswith("/settings.html"):
-    #    await index(writer)
-        #if filename in routes:
-        #print("Routing to ", routes[filename])
-        #await index(writer)
-        #await routes[filename](writer)'''
-    # return
-    
-    if filename.startswith("/api/status"):
-        await writer.awrite(b"HTTP/1.1 200 OK\r\n")
-        await writer.awrite(b"Content-Type: application/json\r\n\r\n")
+@route('/api/alerts')
+async def send_alerts(conn, request, app):
+    # GET /api/alerts - currently firing alerts plus the most recent transitions
+    alerts = app.alerts
+    active = []
+    recent = []
+    if alerts is not None:
+        for sensor_name, rule_name, since in alerts.get_active():
+            active.append({"sensor": sensor_name, "rule": rule_name,
+                           "since": int(since) + MICROPYTHON_EPOCH_OFFSET})
+        for alert in alerts.recent:
+            item = alert.copy()
+            item['ts'] = int(alert['ts']) + MICROPYTHON_EPOCH_OFFSET
+            recent.append(item)
 
-        time_str, uptime_str = get_time()
+    await send_response(conn, b"200 OK", b"application/json", json.dumps({"active": active, "recent": recent}).encode())
 
-        # OPTIMIZED: Reuse dictionary instead of creating new one
-        _temp_dict.clear()
-        _temp_dict["time"] = time_str
-        _temp_dict["uptime"] = uptime_str
+@route('/api/archive', limit=1, bulk=True)
+async def send_archive(conn, request, app):
+    # GET /api/archive?sensors=a,b&since=<unix>&until=<unix>&format=json|csv&tier=raw|hourly|daily
+    # Multi-day history streamed from the btree archive with indexed range scans
+    params = request.params
+    archive = app.archive
+    if archive is None:
+        await send_response(conn, b"404 Not Found")
+        return
 
-        await writer.awrite(json.dumps(_temp_dict).encode())
-        
-        await writer.drain()
+    try:
+        since = _to_logger_time(params.get('since'))
+        until = _to_logger_time(params.get('until'))
+    except ValueError:
+        await send_response(conn, b"400 Bad Request")
+        return
+    sensors = _split_list(params.get('sensors')) or [DEFAULT_SENSOR]
+    as_csv = params.get('format') == 'csv'
+    tier = params.get('tier', 'raw')
+    if tier not in ('raw', 'hourly', 'daily'):
+        await send_response(conn, b"400 Bad Request")
+        return
 
-        print("Closing connection", writer)
-        await writer.aclose()
-        await writer.wait_closed()
+    if as_csv:
+        out = await start_chunked(conn, b"text/csv")
+        if tier == 'raw':
+            await out.write(b"timestamp,sensor_name,temperature\n")
+            lines = archive.iter_csv(sensors, since, until)
+        else:
+            await out.write(b"timestamp,sensor_name,min,max,avg,count\n")
+            lines = (f"{int(ts)},{sensor_name},{mn:.2f},{mx:.2f},{av:.2f},{n}\n"
+                     for sensor_name in sensors
+                     for ts, mn, mx, av, n in archive.scan_rollup(sensor_name, tier, since, until))
+        for line in lines:
+            await out.write(line.encode())
+        await out.close()
         return
-    
-    if filename.startswith("/api/history"):
-        await writer.awrite(b"HTTP/1.1 200 OK\r\n")
-        await writer.awrite(b"Content-Type: application/json\r\n\r\n")
 
-        # TRUE STREAMING: Process records one at a time with ZERO intermediate lists
-        await writer.awrite(b'[')
-        
+    out = await start_chunked(conn, b"application/json")
+    await out.write(b'{')
+    first_sensor = True
+    for sensor_name in sensors:
+        if not first_sensor:
+            await out.write(b',')
+        first_sensor = False
+        await out.write(json.dumps(sensor_name).encode())
+        await out.write(b':[')
+
         first_item = True
-        record_count = 0
-        
-        # Send Unix epoch timestamps - client expects seconds since 1970
-        for timestamp_since_epoch, temperature in logger.stream_history_reverse("a4:c1:38:da:5e:ca", 24*12):
+        if tier == 'raw':
+            items = (f'{{"ts":{int(ts) + MICROPYTHON_EPOCH_OFFSET},"te":{te:.2f}}}'
+                     for ts, te in archive.scan(sensor_name, since, until))
+        else:
+            items = (f'{{"ts":{int(ts) + MICROPYTHON_EPOCH_OFFSET},"min":{mn:.2f},"max":{mx:.2f},"avg":{av:.2f},"count":{n}}}'
+                     for ts, mn, mx, av, n in archive.scan_rollup(sensor_name, tier, since, until))
+        for json_item in items:
             if not first_item:
-                await writer.awrite(b',')
+                await out.write(b',')
             first_item = False
-            
-            # Convert MicroPython epoch (2000) to Unix epoch (1970) and apply timezone
-            unix_timestamp = timestamp_since_epoch + MICROPYTHON_EPOCH_OFFSET
-            
-            # Send raw Unix timestamp (saves bandwidth vs date strings)
-            json_item = f'{{"ts":{unix_timestamp},"te":"{temperature:.2f}"}}'
-            await writer.awrite(json_item.encode())
-            
-            record_count += 1
-            # Periodically drain buffer every 50 records
-            if record_count % 50 == 0:
-                await writer.drain()
-        
-        await writer.awrite(b']')
-        await writer.drain()
+            await out.write(json_item.encode())
+        await out.write(b']')
 
-        print("Closing connection", writer)
-        await writer.aclose()
-        await writer.wait_closed()
+    await out.write(b'}')
+    await out.close()
+
+def _export_rows(logger, archive, sensor_name, since, until):
+    # Archived history up to the oldest record still in the ring, then the ring itself,
+    # so a record held in both is only exported once
+    ring = logger.stream_history(sensor_name, since, until)
+    first = None
+    for first in ring:
+        break
+
+    if archive is not None:
+        archive_until = until
+        if first is not None and (archive_until is None or first[0] < archive_until):
+            archive_until = first[0]
+        yield from archive.scan(sensor_name, since, archive_until)
+
+    if first is not None:
+        yield first
+        yield from ring
+
+@route('/api/export', limit=1, bulk=True)
+async def send_export(conn, request, app):
+    # GET /api/export?format=csv|influx&since=<unix>&until=<unix>&sensors=a,b
+    # Bulk history for Grafana/Influx, streamed with chunked encoding in constant memory
+    params = request.params
+    logger = app.logger
+    archive = app.archive
+    try:
+        since = _to_logger_time(params.get('since'))
+        until = _to_logger_time(params.get('until'))
+    except ValueError:
+        await send_response(conn, b"400 Bad Request")
+        return
+    export_format = params.get('format', 'csv')
+    if export_format not in ('csv', 'influx'):
+        await send_response(conn, b"400 Bad Request")
+        return
+    sensors = _split_list(params.get('sensors')) or logger.get_sensor_names()
+
+    out = await start_chunked(conn, b"text/csv" if export_format == 'csv' else b"text/plain")
+    if export_format == 'csv':
+        await out.write(b"timestamp,sensor_name,temperature\n")
+    for sensor_name in sensors:
+        # Line protocol tag values escape commas, spaces and equals signs
+        tag = sensor_name.replace(',', '\\,').replace(' ', '\\ ').replace('=', '\\=')
+        for timestamp, temperature in _export_rows(logger, archive, sensor_name, since, until):
+            unix_timestamp = int(timestamp) + MICROPYTHON_EPOCH_OFFSET
+            if export_format == 'csv':
+                line = f"{unix_timestamp},{sensor_name},{temperature:.2f}\n"
+            else:
+                line = f"temperature,sensor={tag} value={temperature:.2f} {unix_timestamp}000000000\n"
+            await out.write(line.encode())
+    await out.close()
+
+@route('/api/storage')
+async def send_storage(conn, request, app):
+    # GET /api/storage - flash free space and archive compaction metrics
+    archive = app.archive
+    if archive is None:
+        await send_response(conn, b"404 Not Found")
+        return
+    await send_response(conn, b"200 OK", b"application/json", json.dumps(archive.get_storage_stats()).encode())
+
+def _status_json():
+    time_str, uptime_str = get_time()
+
+    # OPTIMIZED: Reuse dictionary instead of creating new one
+    _temp_dict.clear()
+    _temp_dict["time"] = time_str
+    _temp_dict["uptime"] = uptime_str
+    return json.dumps(_temp_dict).encode()
+
+@route('/api/status')
+async def send_status(conn, request, app):
+    await send_response(conn, b"200 OK", b"application/json", _status_json())
+
+_HTTP_REJECTED = family('tempmon_http_rejected_total', 'counter', 'Connections and requests answered 503 by reason')
+_HTTP_CONNECTIONS = family('tempmon_http_open_connections', 'gauge', 'Open request/response sockets (push streams excluded)')
+_HTTP_EVICTED = family('tempmon_http_idle_evicted_total', 'counter', 'Idle keep-alive connections closed to admit a new client')
+_HTTP_CACHE_HITS = family('tempmon_http_cache_hits_total', 'counter', 'Responses served from a RAM cache')
+_HTTP_CACHE_MISSES = family('tempmon_http_cache_misses_total', 'counter', 'RAM cache lookups that missed')
+_HTTP_CACHE_EVICTIONS = family('tempmon_http_cache_evictions_total', 'counter', 'RAM cache entries evicted')
+_HTTP_CACHE_BYTES = family('tempmon_http_cache_bytes', 'gauge', 'Bytes held by a RAM cache')
+_EVENT_SUBSCRIBERS = family('tempmon_event_subscribers', 'gauge', 'Open push (SSE and WebSocket) clients')
+_EVENTS_PUBLISHED = family('tempmon_events_published_total', 'counter', 'Readings and alerts published to push clients')
+
+async def _render_web_metrics(out, app):
+    # The web server's own families, appended to Metrics.render()
+    await out.write(_HTTP_REJECTED)
+    for reason, count in _rejected.items():
+        await out.write(f'tempmon_http_rejected_total{{reason="{reason}"}} {count}\n'.encode())
+    await out.write(_HTTP_CONNECTIONS + f"tempmon_http_open_connections {_open_connections}\n".encode())
+    await out.write(_HTTP_EVICTED + f"tempmon_http_idle_evicted_total {_evicted}\n".encode())
+    for header, name, attribute in ((_HTTP_CACHE_HITS, 'tempmon_http_cache_hits_total', 'hits'),
+                                    (_HTTP_CACHE_MISSES, 'tempmon_http_cache_misses_total', 'misses'),
+                                    (_HTTP_CACHE_EVICTIONS, 'tempmon_http_cache_evictions_total', 'evictions'),
+                                    (_HTTP_CACHE_BYTES, 'tempmon_http_cache_bytes', 'used')):
+        await out.write(header)
+        await out.write(f'{name}{{cache="asset"}} {getattr(_asset_cache, attribute)}\n'
+                        f'{name}{{cache="response"}} {getattr(_response_cache, attribute)}\n'.encode())
+    if app.events is not None:
+        await out.write(_EVENT_SUBSCRIBERS + f"tempmon_event_subscribers {len(app.events.subscribers)}\n".encode())
+        await out.write(_EVENTS_PUBLISHED + f"tempmon_events_published_total {app.events.published}\n".encode())
+
+@route('/metrics', limit=1)
+async def send_metrics(conn, request, app):
+    # GET /metrics - Prometheus text exposition, written family by family as it is read
+    if app.metrics is None:
+        await send_response(conn, b"404 Not Found")
+        return
+
+    async def web_metrics(out):
+        await _render_web_metrics(out, app)
+
+    out = await start_chunked(conn, METRICS_CONTENT_TYPE, b"Cache-Control: no-store\r\n")
+    await app.metrics.render(out, web_metrics)
+    await out.close()
+
+@route('/api/events', limit=EVENT_CLIENTS)
+async def send_events(conn, request, app):
+    # GET /api/events?sensors=a,b|* - Server-Sent Events: "reading", "alert" and "status" events.
+    # Readings default to DEFAULT_SENSOR like the other endpoints; "*" streams every sensor.
+    if app.events is None:
+        await send_response(conn, b"404 Not Found")
+        return
+    sensors = _split_list(request.params.get('sensors')) or [DEFAULT_SENSOR]
+    subscriber = app.events.subscribe(None if sensors == ['*'] else sensors)
+
+    _start_stream(conn)  # The stream only ends when the client goes away, or stalls
+    out = await start_chunked(conn, b"text/event-stream", b"Cache-Control: no-cache\r\n")
+    try:
+        await out.write(b"retry: 5000\n\nevent: status\ndata: ")
+        await out.write(_status_json())
+        await out.write(b"\n\n")
+        await out.flush()
+
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.event.wait(), STATUS_TICK_S)
+            except asyncio.TimeoutError:
+                await out.write(b"event: status\ndata: ")
+                await out.write(_status_json())
+                await out.write(b"\n\n")
+                await out.flush()
+                continue
+
+            subscriber.event.clear()
+            while subscriber.queue:
+                item = subscriber.queue.pop(0)
+                if item[0] == EVENT_READING:
+                    _, sensor_name, timestamp, temperature, humidity, battery, rssi = item
+                    data = json.dumps({"sensor": sensor_name, "ts": int(timestamp) + MICROPYTHON_EPOCH_OFFSET,
+                                       "te": temperature, "hu": humidity, "ba": battery, "rssi": rssi})
+                    await out.write(b"event: reading\ndata: ")
+                else:
+                    alert = item[1].copy()
+                    alert['ts'] = int(alert['ts']) + MICROPYTHON_EPOCH_OFFSET
+                    data = json.dumps(alert)
+                    await out.write(b"event: alert\ndata: ")
+                await out.write(data.encode())
+                await out.write(b"\n\n")
+            await out.flush()
+    finally:
+        app.events.unsubscribe(subscriber)
+
+async def send_history_bin(conn, logger):
+    # Every stored record of every sensor, written straight from the ring buffer
+    count = logger.count
+    sensor_count = logger.next_sensor_id
+
+    table = bytearray()
+    for sensor_id in range(sensor_count):
+        name = logger.sensor_names[sensor_id]
+        name = name.encode()[:255] if name is not None else b""
+        table.append(len(name))
+        table.extend(name)
+
+    header = struct.pack(HISTORY_BIN_HEADER, HISTORY_BIN_MAGIC, HISTORY_BIN_VERSION, logger.record_size,
+                         int(logger.start_time) + MICROPYTHON_EPOCH_OFFSET, count, sensor_count)
+    # Nothing awaits until every view has been handed to the stream, so a record appended
+    # meanwhile can't change what is sent or make it disagree with the Content-Length
+    conn.write(_response_head(conn, b"200 OK", b"application/octet-stream",
+                              len(header) + len(table) + count * logger.record_size,
+                              b"Cache-Control: no-store\r\n"))
+    conn.write(header + table)
+    for view in logger.record_views():
+        conn.write(view)
+    await conn.drain()
+
+async def send_history_sync(conn, request, logger):
+    # Incremental sync, oldest first:
+    #   {"cursor":"...","reset":bool,"more":bool,"records":[[sensor index,seq,ts,te],...],"sensors":[names]}
+    # Pass the returned cursor back as since= to get only what was appended or updated since.
+    # A record whose seq the client already holds replaces it. "reset" means the since value
+    # was a time (or a stale cursor), so the client should drop what it has for these sensors.
+    params = request.params
+    sensors = _split_list(params.get('sensors')) or [DEFAULT_SENSOR]
+    since = params.get('since')
+    try:
+        limit = int(params['limit']) if params.get('limit') else HISTORY_LIMIT
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+        limit = min(limit, HISTORY_LIMIT)
+
+        start_seq = None
+        if since and not since.isdigit():
+            start_seq = logger.parse_sync_cursor(since)
+            since = None
+        since_time = _to_logger_time(since)
+    except ValueError as e:
+        await send_response(conn, b"400 Bad Request", b"application/json", json.dumps({"error": str(e)}).encode())
+        return
+
+    reset = start_seq is None
+    suffix = ""
+    if reset and since_time is None:
+        # The window moves with the clock, not just the logger generation: it starts on a step
+        # boundary that is part of the ETag, so a cached body never keeps records that aged out
+        window_end = int(time.time()) // HISTORY_WINDOW_STEP_S
+        since_time = window_end * HISTORY_WINDOW_STEP_S - HISTORY_WINDOW_S
+        suffix = f"-w{window_end:x}"
+
+    async def render(out):
+        await _render_history_sync(out, logger, sensors, start_seq, since_time, limit, reset)
+
+    await send_cached(conn, request, _logger_etag(logger, suffix), b"application/json", render)
+
+async def _render_history_sync(out, logger, sensors, start_seq, since_time, limit, reset):
+    # Sensor table, indexed by sensor ID
+    if sensors == ['*']:
+        sensor_ids = None
+        names = [name for name in logger.sensor_names[:logger.next_sensor_id] if name is not None]
+    else:
+        sensor_ids = []
+        names = []
+        for sensor_name in sensors:
+            if sensor_name in logger.name_to_id:
+                sensor_ids.append(logger.name_to_id[sensor_name])
+                names.append(sensor_name)
+    index = {logger.name_to_id[name]: i for i, name in enumerate(names)}
+
+    cursor = logger.cursor(start_seq=start_seq)
+    next_seq = cursor.end_seq
+    await out.write(b'{"records":[')
+    sent = 0
+    if index:
+        for seq, timestamp, sensor_id, temperature in cursor:
+            position = index.get(sensor_id)
+            if position is None or (since_time is not None and timestamp < since_time):
+                continue
+            if sent == limit:
+                next_seq = seq
+                break
+            if sent:
+                await out.write(b',')
+            sent += 1
+            await out.write(f'[{position},{seq},{int(timestamp) + MICROPYTHON_EPOCH_OFFSET},{temperature:.2f}]'.encode())
+
+    more = next_seq < cursor.end_seq
+    if not more:
+        next_seq = logger.sync_resume_seq(sensor_ids, next_seq)
+    await out.write(f'],"sensors":{json.dumps(names)},"cursor":"{logger.sync_cursor(next_seq)}",'
+                    f'"reset":{"true" if reset else "false"},"more":{"true" if more else "false"}}}'.encode())
+
+def _logger_etag(logger, suffix=""):
+    # Changes with every stored record (generation) and with every boot (boot_id)
+    return f'"{logger.boot_id:x}-{logger.generation:x}{suffix}"'.encode()
+
+@route('/api/history', limit=2)
+@route('/api/history/<sensor>', limit=2)
+async def send_history(conn, request, app):
+    # GET /api/history[/<sensor>] - the last 24 hours, newest first
+    # GET /api/history?sensors=a,b|*&since=<unix|cursor>&limit=<n> - incremental sync (send_history_sync)
+    # GET /api/history?format=bin - all sensors in the compact binary layout (HISTORY_BIN_HEADER)
+    params = request.params
+    if params.get('format') == 'bin':
+        await send_history_bin(conn, app.logger)
+        return
+    if 'sensors' in params or 'since' in params or 'limit' in params:
+        await send_history_sync(conn, request, app.logger)
         return
 
-    if filename.startswith("/tempdata"):
-        await writer.awrite(b"HTTP/1.1 200 OK\r\n")
-        await writer.awrite(b"Content-Type: application/json\r\n\r\n")
+    sensor_name = request.path_params.get('sensor', DEFAULT_SENSOR) if request.path_params else DEFAULT_SENSOR
 
+    async def render(out):
+        await _render_history(out, app.logger, sensor_name)
+
+    # Every open dashboard asks for the same thing; it is built once per logger generation
+    await send_cached(conn, request, _logger_etag(app.logger), b"application/json", render)
+
+async def _render_history(out, logger, sensor_name):
+    # TRUE STREAMING: Process records one at a time with ZERO intermediate lists
+    await out.write(b'[')
+    
+    first_item = True
+    
+    # Send Unix epoch timestamps - client expects seconds since 1970
+    for timestamp_since_epoch, temperature in logger.stream_history_reverse(sensor_name, 24*12):
+        if not first_item:
+            await out.write(b',')
+        first_item = False
+        
+        # Convert MicroPython epoch (2000) to Unix epoch (1970) and apply timezone
+        unix_timestamp = timestamp_since_epoch + MICROPYTHON_EPOCH_OFFSET
+        
+        # Send raw Unix timestamp (saves bandwidth vs date strings)
+        json_item = f'{{"ts":{unix_timestamp},"te":"{temperature:.2f}"}}'
+        await out.write(json_item.encode())
+    
+    await out.write(b']')
+
+@route('/tempdata')
+async def send_tempdata(conn, request, app):
+    # GET /tempdata - {"ts", "te"} for DEFAULT_SENSOR
+    # GET /tempdata?sensors=a,b|* - {"ts", "te": {sensor: temperature or null}}
+    # Cached per logger generation and TEMPDATA_CACHE_S period (readings also age out with time)
+    sensors = _split_list(request.params.get('sensors'))
+
+    async def render(out):
         # Send Unix epoch timestamp for consistency with /api/history
         unix_timestamp = int(time.time()) + MICROPYTHON_EPOCH_OFFSET
         
-        current_temps = logger.get_all_current_temps(max_age_minutes=10)
-        temp = current_temps.get("a4:c1:38:da:5e:ca")
+        current_temps = app.logger.get_all_current_temps(max_age_minutes=10)
+        if sensors is None:
+            temp = current_temps.get(DEFAULT_SENSOR)
+            ty = f'{{"ts": {unix_timestamp}, "te": "{temp}"}}'
+        else:
+            if sensors != ['*']:
+                current_temps = {name: current_temps.get(name) for name in sensors}
+            ty = json.dumps({"ts": unix_timestamp, "te": current_temps})
+        await out.write(ty.encode())
 
-        ty = f'{{"ts": {unix_timestamp}, "te": "{temp}"}}'
-           
-        await writer.awrite(ty.encode())
-        await writer.drain()
+    period = int(time.time()) // TEMPDATA_CACHE_S
+    await send_cached(conn, request, _logger_etag(app.logger, f"-{period:x}"), b"application/json", render)
 
-        print("Closing connection", writer)
-        await writer.aclose()
-        await writer.wait_closed()
+async def _ws_read(conn, length):
+    # Next `length` bytes from the client, starting with anything left in the request buffer
+    while conn.filled < length:
+        bytes_read = await conn.reader.readinto(conn.view[conn.filled:length])
+        if not bytes_read:
+            return None
+        conn.filled += bytes_read
+    data = bytes(conn.view[:length])
+    remaining = conn.filled - length
+    if remaining:
+        conn.buffer[:remaining] = conn.buffer[length:conn.filled]
+    conn.filled = remaining
+    return data
+
+async def _ws_send_text(conn, text):
+    payload = text.encode()
+    if len(payload) < 126:
+        await conn.awrite(bytes((0x81, len(payload))) + payload)
+    else:
+        await conn.awrite(bytes((0x81, 126, len(payload) >> 8, len(payload) & 0xFF)) + payload)
+
+async def _ws_receive(conn, subscriber, state):
+    # Client frames: text {"subscribe": [names]} (or ["*"]), ping and close. Runs beside the sender,
+    # which does all the writing: only one task may wait on a socket's output at a time.
+    try:
+        while True:
+            header = await _ws_read(conn, 2)
+            if header is None:
+                break
+            opcode = header[0] & 0x0F
+            length = header[1] & 0x7F
+            if length == 126:
+                extended = await _ws_read(conn, 2)
+                if extended is None:
+                    break
+                length = (extended[0] << 8) | extended[1]
+            if length > WS_MAX_MESSAGE or not header[1] & 0x80:
+                break  # Too large (or 64-bit length), or unmasked - not a valid client frame
+            if opcode & 0x8 and length > 125:
+                state[2] = WS_CLOSE_PROTOCOL_ERROR  # Control frames are limited to 125 bytes
+                break
+            mask = await _ws_read(conn, 4)
+            payload = bytearray(await _ws_read(conn, length) or b"") if length else bytearray()
+            if mask is None or len(payload) != length:
+                break
+            for i in range(length):
+                payload[i] ^= mask[i & 3]
+
+            if opcode == 0x8:
+                break
+            if opcode == 0x9:
+                # Only the latest ping needs an answer (RFC 6455 5.5.3)
+                state[1] = bytes((0x8A, length)) + payload
+                subscriber.event.set()
+            elif opcode == 0x1:
+                message = json.loads(bytes(payload).decode())
+                sensors = message.get('subscribe') if isinstance(message, dict) else None
+                if isinstance(sensors, list):  # Anything else is ignored
+                    subscriber.sensors = None if '*' in sensors else set(sensors)
+    except (OSError, ValueError, AttributeError) as e:
+        print("WebSocket receive ended:", e)
+    finally:
+        state[0] = False
+        subscriber.event.set()  # Wake the sender so it can finish
+
+@route('/api/ws', limit=WS_CLIENTS)
+async def send_websocket(conn, request, app):
+    # GET /api/ws?sensors=a,b|* - WebSocket push of readings as WS_READING binary frames and
+    # alerts as JSON text frames. Clients change sensors with a text frame {"subscribe": [...]}.
+    if app.events is None:
+        await send_response(conn, b"404 Not Found")
+        return
+    key = request.headers.get(b"sec-websocket-key")
+    upgrade = request.headers.get(b"upgrade")
+    if key is None or upgrade is None or b"websocket" not in upgrade.lower():
+        await send_response(conn, b"400 Bad Request")
         return
 
-    #await doodle(writer, filename)
-    
+    accept = binascii.b2a_base64(hashlib.sha1(key + WS_GUID).digest()).strip()
+    _start_stream(conn)  # The socket is the WebSocket's from here on
+    await conn.awrite(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+    await conn.drain()
+
+    sensors = _split_list(request.params.get('sensors')) or [DEFAULT_SENSOR]
+    subscriber = app.events.subscribe(None if sensors == ['*'] else sensors)
+    # [open - cleared by the receiver when the client closes or the socket fails,
+    #  pong frame the receiver wants sent, or None,
+    #  close frame sent when the connection ends]
+    state = [True, None, WS_CLOSE]
+    receiver = asyncio.create_task(_ws_receive(conn, subscriber, state))
+
+    # One frame buffer per connection, refilled in place for every reading
+    frame = bytearray(2 + WS_READING_SIZE)
+    frame[0] = 0x82
+    frame[1] = WS_READING_SIZE
+    ids = {}  # sensor_name -> id used in this connection's frames
     try:
-        with open(f"./assets/{filename}", 'rb') as f:
-            await writer.awrite(b"HTTP/1.1 200 OK\r\n")
-            
-            if filename.endswith('.svg'):
-                await writer.awrite(b"Content-Type: image/svg+xml\r\n")
+        while state[0]:
+            try:
+                await asyncio.wait_for(subscriber.event.wait(), WS_PING_S)
+            except asyncio.TimeoutError:
+                await conn.awrite(b"\x89\x00")
+                await conn.drain()
+                continue
 
-            await writer.awrite(b"\r\n")
+            subscriber.event.clear()
+            if state[1] is not None:
+                pong = state[1]
+                state[1] = None
+                await conn.awrite(pong)
+            while subscriber.queue and state[0]:
+                item = subscriber.queue.pop(0)
+                if item[0] != EVENT_READING:
+                    alert = item[1].copy()
+                    alert['ts'] = int(alert['ts']) + MICROPYTHON_EPOCH_OFFSET
+                    await _ws_send_text(conn, json.dumps({"alert": alert}))
+                    continue
 
-            while True:
-                # OPTIMIZED: Use pre-allocated buffer for larger, more efficient reads
-                bytes_read = f.readinto(_file_buffer)
+                _, sensor_name, timestamp, temperature, humidity, battery, rssi = item
+                sensor_id = ids.get(sensor_name)
+                if sensor_id is None:
+                    if len(ids) > 255:
+                        continue
+                    sensor_id = len(ids)
+                    ids[sensor_name] = sensor_id
+                    await _ws_send_text(conn, json.dumps({"sensor": sensor_id, "name": sensor_name}))
+                struct.pack_into(WS_READING, frame, 2, sensor_id, int(timestamp) + MICROPYTHON_EPOCH_OFFSET,
+                                 int(temperature * 100) if temperature is not None else -32768,
+                                 int(humidity * 100) if humidity is not None else 0xFFFF,
+                                 int(battery) if battery is not None else 0xFF,
+                                 int(rssi) if rssi is not None else -128)
+                await conn.awrite(frame)
+            await conn.drain()
 
-                if bytes_read == 0:
-                    break
+        await conn.awrite(state[2])  # Answer the client's close, or report its protocol error
+    finally:
+        app.events.unsubscribe(subscriber)
+        receiver.cancel()
 
-                # Send only the bytes we actually read
-                if bytes_read == len(_file_buffer):
-                    await writer.awrite(_file_buffer)
-                else:
-                    await writer.awrite(_file_buffer[:bytes_read])
-                await writer.drain()
-    except OSError as e:
-        if e.args[0] != uerrno.ENOENT:
-            print("Error:", e.args[0])
-        else:
-            print(filename, "not found")
-        await writer.aclose()
-        await writer.wait_closed()
+async def serve(conn, request, app):
+    # Writes exactly one framed response; the connection is closed (or kept) by handle()
+    print("Sending", request.path)
+
+    handler = match_route(request)
+    if handler is None:
+        await send_asset(conn, request, request.path.lstrip('/') or 'index.html')
         return
+    if handler in _bulk_routes:
+        conn.deadline = None
 
-    print("Sent", filename)
-    print("Closing connection", writer)
-    await writer.aclose()
-    await writer.wait_closed()
+    limit = _route_limits.get(handler)
+    if limit is None:
+        await handler(conn, request, app)
+        return
+
+    # Expensive route: refuse rather than queue, so a burst of clients can't use up the heap
+    if _route_active[handler] >= limit or gc.mem_free() < ROUTE_MEM_FLOOR:
+        _rejected['route'] += 1
+        conn.keep_alive = False  # Closing also hands this connection's buffers back
+        await conn.awrite(_BUSY_RESPONSE)
+        return
+    _route_active[handler] += 1
+    try:
+        await handler(conn, request, app)
+    finally:
+        _route_active[handler] -= 1
+
+def _admit():
+    # Decide before allocating anything for the connection. Returns the reason for a refusal or None.
+    if _open_connections >= MAX_CONNECTIONS and not _evict_idle():
+        return 'connections'
+    if gc.mem_free() < ADMIT_MEM_FLOOR:
+        gc.collect()
+        if gc.mem_free() < ADMIT_MEM_FLOOR:
+            return 'memory'
+    return None
+
+def _evict_idle():
+    # Make room by closing the longest-idle keep-alive connection. Its slot is handed back by
+    # handle() once the cancelled task has run its finally. Returns False if none is idle.
+    global _evicted
+    if not _idle:
+        return False
+    _idle.pop(0).cancel()
+    _evicted += 1
+    return True
+
+def _start_stream(conn):
+    # A push stream holds its socket until the client goes away, so it moves out of the
+    # MAX_CONNECTIONS budget (its route limit bounds it) and has no total deadline
+    global _open_connections, _push_streams
+    conn.keep_alive = False
+    conn.deadline = None
+    if not conn.stream:
+        conn.stream = True
+        _open_connections -= 1
+        _push_streams += 1
 
-async def handle(reader, writer, logger):
+def _start_response(conn):
+    # Every response gets RESPONSE_TIMEOUT_S from here; push streams and bulk routes clear it
+    conn.deadline = time.ticks_add(time.ticks_ms(), RESPONSE_TIMEOUT_S * 1000)
+
+async def handle(reader, writer, app):
+    global _open_connections, _push_streams
     print("***********************************************", reader)
-    filename = None
+
+    conn = None
     try:
-        while True:
-            items = await asyncio.wait_for(reader.readline(), timeout=5)
+        refused = _admit()
+        if refused is not None:
+            _rejected[refused] += 1
+            print("Refusing connection:", refused)
+            # Nothing is allocated for a refused client - and it only gets WRITE_STALL_S to take the 503
+            await asyncio.wait_for(writer.awrite(_BUSY_RESPONSE), WRITE_STALL_S)
+            return
 
-            if len(items) == 0:
+        conn = Connection(reader, writer)
+        _open_connections += 1
+        task = asyncio.current_task()
+        while conn.keep_alive:
+            # A keep-alive connection may sit idle between requests; the first request must arrive promptly
+            timeout = HEADER_TIMEOUT_S if conn.requests == 0 else IDLE_TIMEOUT_S
+            # Between requests (nothing pipelined) it may be closed to make room for a new client
+            idle = conn.requests > 0 and not conn.filled
+            if idle:
+                _idle.append(task)
+            try:
+                request = await read_request(reader, conn, timeout)
+            except RequestError as e:
+                conn.keep_alive = False
+                _start_response(conn)
+                await send_response(conn, e.args[0])
                 break
+            finally:
+                if idle and task in _idle:
+                    _idle.remove(task)
+            if request is None:
+                break  # Client closed the connection
 
-            items = items.decode('ascii').split()
+            _start_response(conn)
+            conn.requests += 1
+            conn.keep_alive = request.keep_alive and conn.requests < MAX_REQUESTS_PER_CONNECTION
 
-            if len(items) > 0 and items[0] == 'GET':
-                filename = items[1]
+            if request.method != 'GET':
+                # A request body we don't read would be parsed as the next request
+                conn.keep_alive = False
+                await send_response(conn, b"405 Method Not Allowed", extra=b"Allow: GET\r\n")
+                break
 
-            #print(len(items), items)
+            # Pipelined requests simply wait in the connection's buffer until this response is written
+            await serve(conn, request, app)
+            await conn.drain()  # End of response: send whatever is still buffered
 
-            if len(items) == 0:
-                if filename is not None:
-                    await serve(writer, filename, logger)
-                break
-            
+    except asyncio.CancelledError:
+        print("Closing idle connection to admit a new client")
+    except ClientTimeout as e:
+        print("Slow client:", e)
     except asyncio.TimeoutError:
         print("Timeout occurred. Closing connection", reader)
-        await writer.aclose()
-        await writer.wait_closed()
     except Exception as e:
         print(f"Error: {e}")
     finally:
+        # The single place a socket is closed - refused, finished, timed out or failed
+        if conn is None:
+            pass
+        elif conn.stream:
+            _push_streams -= 1
+        else:
+            _open_connections -= 1
+        print("Closing connection", writer)
+        try:
+            await writer.aclose()
+            await writer.wait_closed()
+        except OSError:
+            pass
         print("Finished")
         
 # Keeping original commented function
 #async def start_webserver(logger):
 #    await asyncio.start_server(handle, '0.0.0.0', 80)
 
-async def start_webserver(logger):
-    # Create the server and pass logger to handle
+async def start_webserver(logger, alerts=None, archive=None, asset_cache_bytes=None, events=None, metrics=None):
+    if asset_cache_bytes is not None:
+        _asset_cache.budget = asset_cache_bytes
+    load_assets()
+    # Create the server and pass logger (and optional alert engine and archive) to handle
+    app = App(logger, alerts, archive, events, metrics)
     server = await asyncio.start_server(
-        lambda r, w: handle(r, w, logger), '0.0.0.0', 80
+        lambda r, w: handle(r, w, app), '0.0.0.0', 80
     )
     # Keep this task alive so the server reference isn't garbage collected
     while True:
@@ -10,19 +10,32 @@ import machine, network, socket, ntptime, time
 import asyncio
 import sys
 import random
-from Data import UpdateData, GetData, OpenDB, CloseDB, DumpDB
+from Data import UpdateData, GetData, OpenDB, CloseDB, DumpDB, sensor_data
 from umqttsimple import MQTTClient
 import aioble
 import esp
 import gc
 #import webserver
 from Logger import TemperatureLogger
+from Alerts import AlertEngine
+from Events import EventHub
+from Metrics import Metrics
+from HistoryLog import HistoryLog, WriteBehind
+from Snapshot import save_snapshot, load_snapshot
 from femtoweb import start_webserver
 import micropython
 
 #_IRQ_SCAN_RESULT = const(5)
 #_IRQ_SCAN_DONE = const(6)
 TOPIC = 'tele/BLESensor/SENSOR'
+ALERT_TOPIC = 'tele/BLESensor/ALERT'
+
+DURABILITY_MINUTES = 2  # Most history a power cut can lose
+SNAPSHOT_MINUTES = 15   # Warm-restart snapshot interval
+ARCHIVE_MINUTES = 5     # How often finished ring records are bulk-inserted into the archive
+
+history_log = None
+last_packet_ids = {}  # address -> BTHome packet ID of the last advert handled (repeats are not re-logged)
 
 #my_timer = machine.Timer(0)
 
@@ -37,6 +50,7 @@ TOPIC = 'tele/BLESensor/SENSOR'
 async def scan_data_handler(result):
     try:
         if result.device.addr[0] == 0xa4:
+            metrics.adverts_seen += 1
             address = hexlify(result.device.addr, ":").decode()
             name = result.name()
 
@@ -44,22 +58,34 @@ async def scan_data_handler(result):
 
             if result.adv_data is None or len(result.adv_data) == 0:
                 print(f"{address} - Device Name: '{result.name()}'")
+                metrics.adverts_dropped += 1
                 return
             else:
                 ret = parse_adv_data(result.adv_data)
 
             if ret is None:
                 print(f"Ignoring {address}, {result.name()} = {result.adv_data} received data not in BTHome v2 format")
+                metrics.adverts_dropped += 1
                 return
             else:
-                battery, temperature, humidity, power, voltage = ret
-                print(f"{address} - Name: {name}, Battery:{battery}, Temperature:{temperature}, Humidity:{humidity}, Power:{power}, Voltage:{voltage} RSSI:{result.rssi}")
+                battery, temperature, humidity, power, voltage, packet_id = ret
+                # Sensors repeat each advert several times; the packet ID only changes with new data.
+                # A repeat still proves the sensor is alive and carries a fresh RSSI, so only the
+                # ring write is skipped.
+                repeat = last_packet_ids.get(address) == packet_id
+                if repeat:
+                    metrics.adverts_deduped += 1
+                else:
+                    last_packet_ids[address] = packet_id
+                    metrics.adverts_decoded += 1
+                    print(f"{address} - Name: {name}, Battery:{battery}, Temperature:{temperature}, Humidity:{humidity}, Power:{power}, Voltage:{voltage} RSSI:{result.rssi}")
 
             await UpdateData(address, name, temperature, humidity, battery, result.rssi, voltage, power)
             if name is not None and temperature is not None:
-                await logger.add_detailed_reading(sensor_name=address, temperature=temperature, humidity=humidity, battery_level=battery, rssi=result.rssi, voltage=voltage, power=power)
+                await logger.add_detailed_reading(sensor_name=address, temperature=temperature, humidity=humidity, battery_level=battery, rssi=result.rssi, voltage=voltage, power=power, store=not repeat)
     except Exception as e:
         print(f"Error handling scan result: {e}")
+        metrics.adverts_dropped += 1
 
 '''def handle_scan(ev, data):
     if ev == _IRQ_SCAN_RESULT:
@@ -171,7 +197,7 @@ def parse_adv_data(adv_data: bytes):
                 print(f"Unknown BTHome type: 0x{typ:02x} at offset {start}")
                 break
 
-    return battery, temperature, humidity, power, voltage
+    return battery, temperature, humidity, power, voltage, PacketID
 
 
 async def DoNothing():
@@ -215,7 +241,12 @@ async def send_mqtt():
 
                 if Temperature != 0 and Temperature is not None and Name is not None:
                     message = f'{{"Time":"{now[0]}-{now[1]:02}-{now[2]:02}T{now[3]:02}:{now[4]:02}:{now[5]:02}","{Name}":{{"mac":"{ID}","Temperature":{Temperature},"Humidity":{Humidity},"DewPoint":16.1,"Battery":{Battery},"RSSI":{RSSI}}},"TempUnit":"C"}}'
-                    await mqtt.publish(topic=TOPIC, msg=message, qos=0)
+                    try:
+                        await mqtt.publish(topic=TOPIC, msg=message, qos=0)
+                    except Exception:
+                        metrics.mqtt_failed += 1
+                        raise
+                    metrics.mqtt_published += 1
                     await asyncio.sleep_ms(10)  # Small delay between publishes
                         #await asyncio.sleep_ms(100) 
                     #except:
@@ -236,6 +267,54 @@ async def send_mqtt():
         print("-" * 20)
         print()
 
+async def send_alerts():
+    # Publish alert transitions as soon as they happen rather than on the 60s cycle
+    while True:
+        await alerts.event.wait()
+        alerts.event.clear()
+
+        while alerts.pending:
+            if mqtt.writer is None:
+                # Not connected yet - send_mqtt will reconnect, keep the alerts queued
+                await asyncio.sleep(5)
+                continue
+
+            alert = alerts.pending[0]
+            now = time.localtime(alert['ts'] + 3600 * 10) # Timezone is UTC+10
+            value = "null" if alert['value'] is None else alert['value']
+            message = f'{{"Time":"{now[0]}-{now[1]:02}-{now[2]:02}T{now[3]:02}:{now[4]:02}:{now[5]:02}","mac":"{alert["sensor"]}","Rule":"{alert["rule"]}","State":"{alert["state"]}","Temperature":{value}}}'
+            try:
+                await mqtt.publish(topic=ALERT_TOPIC, msg=message, qos=0)
+                alerts.pending.pop(0)
+                metrics.mqtt_published += 1
+            except Exception as e:
+                print(f"MQTT alert publish error: {e}")
+                metrics.mqtt_failed += 1
+                await asyncio.sleep(5)
+
+def take_snapshot():
+    # Flush first so the snapshot's log position covers everything in the ring
+    history_log.flush()
+    save_snapshot(logger, sensor_data, log_file.position())
+
+async def save_snapshots():
+    while True:
+        await asyncio.sleep(SNAPSHOT_MINUTES * 60)
+        try:
+            take_snapshot()
+        except OSError as e:
+            print(f"Snapshot failed: {e}")
+
+async def archive_history():
+    while True:
+        await asyncio.sleep(ARCHIVE_MINUTES * 60)
+        try:
+            inserted = await archive.archive_from(logger)
+            print(f"Archived {inserted} records")
+        except Exception as e:
+            # Keep the task alive - the next pass resumes from archive.next_seq
+            print(f"Archive error: {e}")
+
 async def scan_ble():
     while True:
         gc.collect()
@@ -267,11 +346,17 @@ async def scan_ble():
     
 def exit_handler():
     print('Application exiting')
+    if history_log is not None:
+        try:
+            take_snapshot()  # Lets a soft reset restart warm
+        except OSError as e:
+            print(f"Snapshot failed: {e}")
+        history_log.close()  # Write out anything still buffered
     if mqtt is not None:
         mqtt.disconnect()
     #my_timer.deinit()
     #BLE().active(False)
-    #CloseDB()
+    CloseDB()
     sys.exit()
 
     
@@ -316,7 +401,29 @@ mqtt = MQTTClient("123", MQTTHost, port = 1883, keepalive = 10000, ssl = False)
 #client = MQTTClient(config)
 
 logger = TemperatureLogger(2880)  # 24 hours at one reading every 5 minutes x 10 sensors
-#OpenDB()
+
+# Rebuild the ring from the flash log, then log every new record (appends run on the asyncio loop)
+# through a write-behind layer that coalesces latest-wins updates between flushes
+# A warm-restart snapshot (if any) is read straight into the ring first, so only the log
+# blocks written after it need replaying
+log_file = HistoryLog('hist')
+log_file.recover(logger, load_snapshot(logger, sensor_data))
+history_log = WriteBehind(log_file, durability_minutes=DURABILITY_MINUTES)
+logger.record_hooks.append(history_log.on_record)
+
+# Alert rules are compiled once here and evaluated on every reading
+alerts = AlertEngine()
+alerts.load('alerts.json')
+logger.reading_hooks.append(alerts.on_reading)
+
+# Live readings and alerts are pushed to /api/events clients as they happen
+events = EventHub()
+logger.reading_hooks.append(events.on_reading)
+alerts.listeners.append(events.on_alert)
+archive = OpenDB()
+
+# Counters and live state exported at /metrics for Prometheus
+metrics = Metrics(logger, sensor_data, history_log, archive)
 
 # Set up Bluetooth low-energy scan
 #StartBTScan()
@@ -327,10 +434,17 @@ logger = TemperatureLogger(2880)  # 24 hours at one reading every 5 minutes x 10
 # Run the BLE scan, MQQT publish, web server and any other async tasks
 try:
     loop = asyncio.get_event_loop()
-    loop.create_task(start_webserver(logger))
+    loop.create_task(start_webserver(logger, alerts, archive, events=events, metrics=metrics))
     #loop.create_task(server.run())
     loop.create_task(scan_ble())
     loop.create_task(send_mqtt())
+    loop.create_task(send_alerts())
+    loop.create_task(history_log.run())
+    loop.create_task(save_snapshots())
+    loop.create_task(archive_history())
+    loop.create_task(archive.run_retention())
+    loop.create_task(alerts.run_stale_checks())
+    loop.create_task(metrics.run_lag_probe())
     loop.run_forever()
 
 except Exception as e: